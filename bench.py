@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+import urllib.request
+from datetime import datetime
+
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+# Нагрузочный прогон настоящих обработчиков бота против локальной заглушки Bot API.
+# Обновления передаются в Application.process_update напрямую, как это делает webhook.
+# Заглушка работает в отдельном процессе, чтобы не отнимать время у измеряемого цикла событий.
+
+BOT_TOKEN = '123456:bench'
+
+class FakeBotAPI(web.RequestHandler):
+    message_ids = itertools.count(1)
+    latency = 0.0
+    calls = 0
+
+    def _params(self):
+        if self.request.body_arguments:
+            return {key: value[0].decode() for key, value in self.request.body_arguments.items()}
+        if self.request.body:
+            return json.loads(self.request.body)
+        return {}
+
+    def _message(self, params):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id') or 1), 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+        if params.get('reply_markup'):
+            markup = params['reply_markup']
+            message['reply_markup'] = json.loads(markup) if isinstance(markup, str) else markup
+        return message
+
+    async def post(self, token, method):
+        FakeBotAPI.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = self._params()
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendPhoto', 'sendDocument'):
+            result = self._message(params)
+        elif method == 'copyMessage':
+            result = {'message_id': next(self.message_ids)}
+        else:
+            result = True
+        self.write({'ok': True, 'result': result})
+
+class FakeBotAPIStats(web.RequestHandler):
+    def get(self):
+        self.write({'calls': FakeBotAPI.calls})
+
+def serve_fake_api(ready, latency):
+    FakeBotAPI.latency = latency
+
+    async def serve():
+        sockets = bind_sockets(0, '127.0.0.1')
+        server = HTTPServer(web.Application([
+            (r'/bot([^/]+)/(\w+)', FakeBotAPI),
+            (r'/stats', FakeBotAPIStats),
+        ]))
+        server.add_sockets(sockets)
+        ready.put(sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+def start_fake_api(latency):
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_fake_api, args=(ready, latency), daemon=True)
+    process.start()
+    return process, ready.get(timeout=30)
+
+def fake_api_calls(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as response:
+        return json.load(response)['calls']
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.update_ids = itertools.count(1)
+
+    async def feed(self, application, step, payload):
+        from telegram import Update
+        update = Update.de_json(dict(payload, update_id=next(self.update_ids)), application.bot)
+        started = time.perf_counter()
+        await application.process_update(update)
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+
+    def report(self, elapsed):
+        total = sum(len(values) for values in self.latencies.values())
+        merged = [value for values in self.latencies.values() for value in values]
+        return {
+            'updates': total,
+            'updates_per_sec': round(total / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(merged, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(merged, 0.99) * 1000, 2),
+            'steps': {
+                step: {
+                    'count': len(values),
+                    'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                    'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                }
+                for step, values in self.latencies.items()
+            },
+        }
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+def text_message(user_id, text, message_id=1):
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+def callback(user_id, data, message_id=1, reply_markup=None):
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'text': '...',
+    }
+    if reply_markup is not None:
+        message['reply_markup'] = reply_markup
+    return {'callback_query': {
+        'id': f'{user_id}:{data}',
+        'from': user(user_id),
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': message,
+    }}
+
+async def run_concurrently(items, concurrency, func):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def guarded(item):
+        async with semaphore:
+            await func(item)
+
+    await asyncio.gather(*(guarded(item) for item in items))
+
+class DBWrites:
+    def __init__(self, bot):
+        self.metrics = bot.metrics
+        self.started = self._snapshot()
+
+    def _snapshot(self):
+        return (self.metrics.counter_value('bot_db_write_ops_total'), self.metrics.counter_value('bot_db_commits_total'))
+
+    def report(self, elapsed):
+        ops, commits = (now - before for now, before in zip(self._snapshot(), self.started))
+        return {
+            'db_write_ops': ops,
+            'db_writes_per_sec': round(ops / elapsed, 1) if elapsed else 0.0,
+            'db_commits_per_sec': round(commits / elapsed, 1) if elapsed else 0.0,
+        }
+
+async def bench_user_flow(bot, application, args):
+    recorder = Recorder()
+    writes = DBWrites(bot)
+    first_user = 1_000_000
+
+    async def flow(user_id):
+        await recorder.feed(application, 'start', text_message(user_id, '/start'))
+        await recorder.feed(application, 'language', callback(user_id, 'lang_ru'))
+        await recorder.feed(application, 'start_trade', callback(user_id, 'start_trade'))
+        await recorder.feed(application, 'submit', text_message(user_id, f'https://example.com/trade/{user_id}\nS{user_id}'))
+
+    started = time.perf_counter()
+    await run_concurrently(range(first_user, first_user + args.users), args.concurrency, flow)
+    elapsed = time.perf_counter() - started
+    return dict(recorder.report(elapsed), seconds=round(elapsed, 2), **writes.report(elapsed))
+
+async def bench_approvals(bot, application, args):
+    recorder = Recorder()
+    writes = DBWrites(bot)
+    admin_id = bot.ADMIN_IDS[0]
+    requests, _, _ = await bot.adb.get_pending_requests(per_page=args.approvals)
+
+    async def decide(request):
+        request_id = request['request_id']
+        action = 'accept' if request_id % 2 else 'reject'
+        markup = {'inline_keyboard': [[
+            {'text': 'reject', 'callback_data': f'reject_{request_id}'},
+            {'text': 'accept', 'callback_data': f'accept_{request_id}'},
+        ]]}
+        await recorder.feed(application, action, callback(admin_id, f'{action}_{request_id}', reply_markup=markup))
+
+    started = time.perf_counter()
+    await run_concurrently(requests, args.concurrency, decide)
+    elapsed = time.perf_counter() - started
+    return dict(recorder.report(elapsed), seconds=round(elapsed, 2), **writes.report(elapsed))
+
+async def bench_broadcast(bot, application, args):
+    first_user = 2_000_000
+    users = [(user_id, f'user{user_id}', 'ru') for user_id in range(first_user, first_user + args.broadcast)]
+    bot.db._write(lambda cursor: cursor.executemany(
+        'INSERT OR IGNORE INTO users (user_id, username, lang) VALUES (?, ?, ?)', users
+    ))
+    admin_id = bot.ADMIN_IDS[0]
+    job_id = await bot.adb.create_broadcast_job(admin_id, admin_id, 1, 'Benchmark broadcast')
+    job = await bot.adb.get_broadcast_job(job_id)
+
+    writes = DBWrites(bot)
+    sent_before = bot.metrics.counter_value('bot_deliveries_total', engine='broadcast', status='sent')
+    started = time.perf_counter()
+    await bot.run_broadcast(application.bot, job)
+    elapsed = time.perf_counter() - started
+    sent = bot.metrics.counter_value('bot_deliveries_total', engine='broadcast', status='sent') - sent_before
+    return dict(
+        recipients=job['total_users'],
+        sent=sent,
+        seconds=round(elapsed, 2),
+        deliveries_per_sec=round(sent / elapsed, 1) if elapsed else 0.0,
+        **writes.report(elapsed)
+    )
+
+async def run(args):
+    process, port = start_fake_api(args.api_latency / 1000)
+    os.environ['TELEGRAM_API_URL'] = f'http://127.0.0.1:{port}'
+    # Настраиваем логирование до импорта бота, иначе его basicConfig включит INFO
+    logging.basicConfig(level=logging.WARNING)
+    import bot
+
+    application = bot.build_application()
+    results = {}
+    async with application:
+        if args.users:
+            results['user_flow'] = await bench_user_flow(bot, application, args)
+        if args.approvals:
+            results['approvals'] = await bench_approvals(bot, application, args)
+        if args.broadcast:
+            results['broadcast'] = await bench_broadcast(bot, application, args)
+        await bot.on_shutdown(application)
+    bot.adb.close()
+    bot.db.close()
+    results['api_calls'] = fake_api_calls(port)
+    process.terminate()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота против заглушки Bot API')
+    parser.add_argument('--users', type=int, default=1000, help='пользователей в сценарии /start → язык → заявка')
+    parser.add_argument('--approvals', type=int, default=1000, help='сколько заявок одобряет/отклоняет админ')
+    parser.add_argument('--broadcast', type=int, default=100_000, help='получателей рассылки')
+    parser.add_argument('--concurrency', type=int, default=100, help='одновременно обрабатываемых пользователей')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа заглушки, мс')
+    parser.add_argument('--output', default='bench_output.txt', help='файл, в который дописываются результаты')
+    parser.add_argument('--label', default='', help='метка прогона для сравнения')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    os.environ['DB_FILE'] = os.path.join(workdir, 'bench.db')
+    os.environ['TELEGRAM_BOT_TOKEN'] = BOT_TOKEN
+    # Лимиты Telegram к заглушке не относятся: меряем сам бот
+    os.environ.setdefault('GLOBAL_RATE_LIMIT', '1000000')
+    os.environ.setdefault('OUTBOUND_WORKERS', '64')
+    os.environ.setdefault('BROADCAST_CONCURRENCY', '256')
+    os.environ.setdefault('METRICS_PORT', '0')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'label': args.label, 'args': vars(args), 'results': results}
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,38 @@
 import os
+import re
+import sys
+import csv
+import json
+import argparse
+import hashlib
 import sqlite3
-from datetime import datetime
+import asyncio
+import itertools
+import multiprocessing
+import queue
+import signal
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial, wraps
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from telegram import (
     Update,
+    CallbackQuery,
     InlineKeyboardButton,
-    InlineKeyboardMarkup
+    InlineKeyboardMarkup,
+    Message,
+    MessageEntity
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
+    TypeHandler,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -27,13 +52,336 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Состояния
-LANGUAGE, TRADE, ADMIN_MAIN, ADMIN_STATS, ADMIN_REQUESTS, ADMIN_BROADCAST, ADMIN_BROADCAST_CONFIRM = range(7)
+(LANGUAGE, TRADE, ADMIN_MAIN, ADMIN_STATS, ADMIN_REQUESTS, ADMIN_BROADCAST, ADMIN_BROADCAST_CONFIRM,
+ ADMIN_BULK_FILTER, ADMIN_BROADCAST_SEGMENT) = range(9)
 
 # Настройки
 ADMIN_IDS = [8126533622]  # Замените на ваш ID
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN') or '7715353196:AAEvyhRGpqFrUrL_eC9HMozwn9IdyIWwBM4'
-DB_FILE = 'bot_database.db'
-BROADCAST_LOCK = threading.Lock()
+DB_FILE = os.getenv('DB_FILE', 'bot_database.db')
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'locales')
+DEFAULT_LANG = 'ru'
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Например, локальный Bot API сервер или заглушка для тестов
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Если задан, бот принимает обновления через webhook
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '1'))
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))  # Больше 1 - обновления обрабатывают отдельные процессы
+WORKER_CHECK_INTERVAL = 1.0  # Как часто ингресс проверяет, что воркеры живы, сек
+LEASE_TTL = float(os.getenv('LEASE_TTL', '30'))  # Через сколько секунд фоновую работу упавшего процесса подхватит другой
+LEASE_OWNER = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 - эндпоинт метрик выключен
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_WORKERS = int(os.getenv('DB_WORKERS', '4'))
+WRITE_BATCH_SIZE = 100  # Максимум операций в одной транзакции
+WRITE_BATCH_DELAY = 0.005  # Сколько ждать следующих записей перед коммитом (сек)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '60'))  # Как часто сохранять время последней активности, сек
+MAU_DAYS = 30
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))  # Как часто сохранять состояния диалогов, сек
+STATS_CACHE_TTL = 5  # Сколько секунд показывать один и тот же снимок статистики
+GLOBAL_RATE_LIMIT = float(os.getenv('GLOBAL_RATE_LIMIT', '25'))  # Лимит Telegram ~30 сообщений/сек
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))
+OUTBOUND_MAX_RETRIES = 5  # Для TimedOut/NetworkError
+OUTBOUND_BACKOFF_BASE = 1.0  # Задержка перед повтором растёт вдвое: 1, 2, 4... сек
+OUTBOUND_BACKOFF_MAX = 60.0
+PRIORITY_INTERACTIVE, PRIORITY_BULK = 0, 1  # Ответы пользователям идут раньше рассылок
+USER_CHUNK_SIZE = 1000  # Размер порции при обходе пользователей
+BROADCAST_CHECKPOINT_SIZE = 100  # Сохранять прогресс рассылки каждые N сообщений
+BROADCAST_CHECKPOINT_INTERVAL = 2.0  # ...или не реже чем раз в столько секунд
+SWEEP_CONCURRENCY = int(os.getenv('SWEEP_CONCURRENCY', '10'))
+SWEEP_RECHECK_HOURS = int(os.getenv('SWEEP_RECHECK_HOURS', '24'))  # Не проверять повторно раньше
+SWEEP_PROGRESS_INTERVAL = 5.0  # Как часто обновлять сообщение с прогрессом (сек)
+ADMIN_DIGEST_WINDOW = float(os.getenv('ADMIN_DIGEST_WINDOW', '0'))  # 0 - уведомлять о каждой заявке сразу
+ADMIN_DIGEST_MAX_LENGTH = 3500  # Запас до лимита Telegram в 4096 символов
+ADMIN_DIGEST_MAX_REQUESTS = 20
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))  # 0 - не архивировать обработанные заявки
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+ARCHIVE_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+# Лимиты на пользователя по категориям обновлений: "категория=сколько/за сколько секунд"
+FLOOD_LIMITS = os.getenv('FLOOD_LIMITS', 'message=10/60,callback=30/60,command=10/60')
+BACKGROUND_TASKS = set()
+
+class Metrics:
+    # Счётчики и гистограммы в текстовом формате Prometheus; пишутся и из потоков базы данных
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, func):
+        self._gauges[name] = func
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self._format_labels(labels)} {value}')
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append(f'{name}_bucket{self._format_labels(labels + (("le", bound),))} {bucket_count}')
+            lines.append(f'{name}_bucket{self._format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {total}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+        for name, func in sorted(self._gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def count_rows(result):
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple):
+        return count_rows(result[0]) if result else 0
+    return 1 if isinstance(result, sqlite3.Row) else 0
+
+def timed_query(func):
+    # Время запроса и число затронутых строк для каждого метода Database
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = func(self, *args, **kwargs)
+        finally:
+            metrics.observe('bot_db_query_seconds', time.perf_counter() - started, method=func.__name__)
+        metrics.inc('bot_db_rows_total', count_rows(result), method=func.__name__)
+        return result
+    return wrapper
+
+def write_query(func):
+    # Метод записи возвращает Future своей операции в очереди писателя. Синхронный вызов ждёт коммита,
+    # AsyncDatabase ждёт тот же Future из event loop, не занимая поток пула
+    @wraps(func)
+    def submit(self, *args, **kwargs):
+        started = time.perf_counter()
+        future = func(self, *args, **kwargs)
+
+        def done(future):
+            metrics.observe('bot_db_query_seconds', time.perf_counter() - started, method=func.__name__)
+            metrics.inc('bot_db_rows_total', getattr(future, 'rows', 0), method=func.__name__)
+
+        future.add_done_callback(done)
+        return future
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return submit(self, *args, **kwargs).result()
+
+    wrapper.submit = submit
+    return wrapper
+
+def instrument_handler(func):
+    @wraps(func)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=func.__name__)
+            raise
+        finally:
+            metrics.observe('bot_handler_latency_seconds', time.perf_counter() - started, handler=func.__name__)
+    return wrapper
+
+TELEGRAM_LINK_HOSTS = {'t.me', 'telegram.me', 'telegram.dog'}
+
+def normalize_link(link):
+    # Приводит разные записи одной ссылки к одному виду: схема, www, регистр домена,
+    # t.me/joinchat/X и t.me/+X, @username, хвостовой слэш, utm-метки и якорь ссылок Telegram
+    raw = link.strip()
+    link = raw
+    if link.startswith('@'):
+        link = f't.me/{link[1:]}'
+    if '://' not in link:
+        link = f'https://{link}'
+    try:
+        parts = urlsplit(link)
+    except ValueError:
+        # Не разбирается как URL (например, "[Mega] моя папка") - сравниваем строку как есть
+        return raw.lower()
+    host = parts.netloc.lower().rsplit('@', 1)[-1]
+    if host.startswith('www.'):
+        host = host[4:]
+    path = parts.path.rstrip('/')
+    # У облачных ссылок вида mega.nz/#F!id!key вся ссылка в якоре, его отбрасываем только для Telegram
+    fragment = parts.fragment
+    if host in TELEGRAM_LINK_HOSTS:
+        host = 't.me'
+        if path.startswith('/joinchat/'):
+            path = '/+' + path[len('/joinchat/'):]
+        elif not path.startswith('/+'):
+            # Имена каналов и групп не зависят от регистра, хеши приглашений - зависят
+            path = path.lower()
+        if path:
+            fragment = ''
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query) if not key.startswith('utm_')))
+    return urlunsplit(('https', host, path, query, fragment))
+
+def link_hash(link):
+    # 64-битный отпечаток нормализованной ссылки: компактный ключ для индекса дубликатов
+    digest = hashlib.sha256(normalize_link(link).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+def pending_requests_sql(condition='', order='DESC'):
+    return f'''SELECT r.request_id, r.created_at, u.user_id, u.username 
+    FROM requests r
+    JOIN users u ON r.user_id = u.user_id
+    WHERE r.status = 'pending' {condition}
+    ORDER BY r.created_at {order}, r.request_id {order}
+    LIMIT ?'''
+
+def has_pending_request_sql(op):
+    return f'''SELECT 1 FROM requests 
+    WHERE status = 'pending' AND (created_at, request_id) {op} (?, ?)
+    LIMIT 1'''
+
+# Запросы, планы которых проверяет Database.check_query_plans; методы берут SQL отсюда же
+HOT_QUERIES = {
+    'get_pending_requests_first': (pending_requests_sql(), (11,)),
+    'get_pending_requests_older': (
+        pending_requests_sql('AND (r.created_at, r.request_id) < (?, ?)', 'DESC'), ('2024-01-01 00:00:00', 1, 11)
+    ),
+    'get_pending_requests_newer': (
+        pending_requests_sql('AND (r.created_at, r.request_id) > (?, ?)', 'ASC'), ('2024-01-01 00:00:00', 1, 11)
+    ),
+    'has_pending_request_newer': (has_pending_request_sql('>'), ('2024-01-01 00:00:00', 1)),
+    'has_pending_request_older': (has_pending_request_sql('<'), ('2024-01-01 00:00:00', 1)),
+    'get_stats_days': ('''SELECT * FROM daily_stats 
+    WHERE day IN (date('now'), date('now', '-1 day')) ORDER BY day DESC''', ()),
+    'get_pending_deliveries_chunk': ('''SELECT user_id FROM broadcast_deliveries 
+    WHERE job_id = ? AND user_id > ? AND status = 'pending'
+    ORDER BY user_id LIMIT ?''', (1, 0, 1000)),
+    'find_duplicate_request': ('''SELECT request_id, status FROM requests 
+    WHERE link_hash = ? AND status IN ('pending', 'approved')
+    UNION ALL
+    SELECT request_id, status FROM requests_archive 
+    WHERE link_hash = ? AND status = 'approved'
+    LIMIT 1''', (0, 0)),
+    'segment_all': ('SELECT ?, user_id FROM users WHERE blocked = 0', (1,)),
+    'segment_lang': ('SELECT ?, user_id FROM users WHERE blocked = 0 AND lang = ?', (1, 'ru')),
+    'segment_signup': ('''SELECT ?, user_id FROM users 
+    WHERE blocked = 0 AND created_at >= ? AND created_at < ?''', (1, '2024-01-01', '2024-02-01')),
+    # Обход идёт от свежих заявок по created_at, пользователи ищутся по ключу: CROSS JOIN
+    # фиксирует порядок, иначе планировщик начинает с users и на каждого перебирает заявки.
+    # Дубликаты пользователей отсекает первичный ключ broadcast_deliveries при INSERT OR IGNORE
+    'segment_requesters': ('''SELECT ?, u.user_id FROM (
+        SELECT user_id FROM requests WHERE created_at >= datetime('now', ?)
+        UNION ALL
+        SELECT user_id FROM requests_archive WHERE created_at >= datetime('now', ?)
+    ) r CROSS JOIN users u ON u.user_id = r.user_id
+    WHERE u.blocked = 0''', (1, '-7 days', '-7 days')),
+    'get_archivable_requests': ('''SELECT request_id FROM requests 
+    WHERE processed_at < datetime('now', ?) 
+    ORDER BY processed_at LIMIT ?''', ('-30 days', 1000)),
+}
+
+REQUEST_COLUMNS = 'request_id, user_id, link, summer_id, status, created_at, processed_at, link_hash'
+
+# Выгрузка для python bot.py export; архивные заявки отдаются вместе с рабочими
+EXPORT_QUERIES = {
+    'users': 'SELECT * FROM users',
+    'requests': f'''SELECT {REQUEST_COLUMNS}, 0 AS archived FROM requests
+    UNION ALL
+    SELECT {REQUEST_COLUMNS}, 1 AS archived FROM requests_archive''',
+    'broadcast_history': 'SELECT * FROM broadcast_history',
+}
+
+class UserCache:
+    # LRU-кэш строк users с ограничением по времени жизни
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None:
+                expires_at, row = item
+                if expires_at > time.monotonic():
+                    self._items.move_to_end(user_id)
+                    self.hits += 1
+                    return True, row
+                del self._items[user_id]
+            self.misses += 1
+            return False, None
+
+    def version(self):
+        return self._version
+
+    def set(self, user_id, row, version):
+        with self._lock:
+            # Пока читали из базы, запись могла устареть
+            if version != self._version:
+                return
+            self._items[user_id] = (time.monotonic() + self.ttl, row)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            self._version += 1
+            for user_id in user_ids:
+                self._items.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
 
 class Database:
     _instance = None
@@ -48,13 +396,149 @@ class Database:
         return cls._instance
 
     def _initialize_db(self):
-        self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
-        self._create_tables()
+        # Соединение для записи принадлежит потоку-писателю, транзакциями управляем вручную
+        self.conn = self._connect(isolation_level=None)
+        self._migrate()
+
+        self.user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self._stats_snapshot = None
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+        self._write_queue = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self, **kwargs):
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, **kwargs)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def _reader(self):
+        # В режиме WAL чтение из отдельного соединения не ждёт писателя
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def _submit(self, func, after=None):
+        # after(result) выполняется в потоке-писателе после коммита, до того как Future будет готов
+        future = Future()
+        self._write_queue.put((func, after, future))
+        return future
+
+    def _write(self, func):
+        return self._submit(func).result()
+
+    def _writer_loop(self):
+        stop = False
+        while not stop:
+            item = self._write_queue.get()
+            if item is None:
+                break
 
-    def _create_tables(self):
+            batch = [item]
+            deadline = time.monotonic() + WRITE_BATCH_DELAY
+            while len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        # Отменённые до начала записи операции не выполняются
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
         cursor = self.conn.cursor()
-        
+        results = []
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for func, after, future in batch:
+                # Ошибка одной операции не должна откатывать всю пачку
+                cursor.execute('SAVEPOINT write_op')
+                changes = self.conn.total_changes
+                future.rows = 0
+                try:
+                    results.append((future, after, func(cursor), None))
+                    future.rows = self.conn.total_changes - changes
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write_op')
+                    results.append((future, None, None, e))
+                cursor.execute('RELEASE write_op')
+            cursor.execute('COMMIT')
+            metrics.inc('bot_db_commits_total')
+            metrics.inc('bot_db_write_ops_total', len(batch))
+        except Exception as e:
+            logger.error(f"Failed to commit {len(batch)} writes: {e}")
+            if self.conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, after, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+                continue
+            if after is not None:
+                try:
+                    after(result)
+                except Exception as e:
+                    logger.error(f"Post-commit hook failed: {e}")
+            future.set_result(result)
+
+    def _migrate(self):
+        # Версия схемы хранится в PRAGMA user_version, каждая миграция применяется один раз
+        migrations = [
+            self._migration_initial_tables,
+            self._migration_broadcast_jobs,
+            self._migration_last_checked_at,
+            self._migration_hot_query_indexes,
+            self._migration_stats_rollups,
+            self._migration_persistence,
+            self._migration_leases,
+            self._migration_link_hash,
+            self._migration_requests_archive,
+            self._migration_username_index,
+            self._migration_broadcast_media,
+            self._migration_broadcast_segments,
+            self._migration_user_activity,
+            self._migration_link_hash_fragments,
+        ]
+        cursor = self.conn.cursor()
+        while True:
+            cursor.execute('BEGIN IMMEDIATE')
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(migrations):
+                cursor.execute('COMMIT')
+                return
+            try:
+                migrations[version](cursor)
+                cursor.execute(f'PRAGMA user_version = {version + 1}')
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            logger.info(f"Applied database migration {version + 1}")
+
+    def _migration_initial_tables(self, cursor):
         cursor.execute('''CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -84,177 +568,1334 @@ class Database:
             failed_count INTEGER,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP
         )''')
+
+    def _migration_broadcast_jobs(self, cursor):
+        cursor.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            message_text TEXT,
+            status TEXT DEFAULT 'running',
+            total_users INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT
+        )''')
         
-        self.conn.commit()
+        # Одновременно может выполняться только одна рассылка
+        cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcast_jobs_running
+        ON broadcast_jobs(status) WHERE status = 'running' ''')
+        
+        cursor.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            updated_at TEXT,
+            PRIMARY KEY (job_id, user_id),
+            FOREIGN KEY(job_id) REFERENCES broadcast_jobs(job_id)
+        ) WITHOUT ROWID''')
+
+    def _migration_last_checked_at(self, cursor):
+        self._add_column(cursor, 'users', 'last_checked_at', 'TEXT')
 
+    def _migration_hot_query_indexes(self, cursor):
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_requests_status_created
+        ON requests(status, created_at)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_requests_user
+        ON requests(user_id)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_users_blocked_created
+        ON users(blocked, created_at)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status
+        ON broadcast_deliveries(job_id, status, user_id)''')
+
+    def _migration_stats_rollups(self, cursor):
+        # signups - зарегистрировавшиеся за день и не заблокировавшие бота
+        cursor.execute('''CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            signups INTEGER DEFAULT 0,
+            blocks INTEGER DEFAULT 0,
+            requests_created INTEGER DEFAULT 0,
+            requests_approved INTEGER DEFAULT 0,
+            requests_rejected INTEGER DEFAULT 0
+        ) WITHOUT ROWID''')
+        
+        cursor.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER DEFAULT 0
+        ) WITHOUT ROWID''')
+        
+        # Заполняем по уже накопленным данным; дни блокировок и решений по заявкам неизвестны
+        cursor.execute('DELETE FROM daily_stats')
+        cursor.execute('''INSERT INTO daily_stats (day, signups)
+        SELECT date(created_at), COUNT(*) FROM users WHERE blocked = 0 GROUP BY date(created_at)''')
+        cursor.execute('''INSERT INTO daily_stats (day, requests_created)
+        SELECT date(created_at), COUNT(*) FROM requests WHERE true GROUP BY date(created_at)
+        ON CONFLICT(day) DO UPDATE SET requests_created = excluded.requests_created''')
+        
+        cursor.execute('DELETE FROM stats_counters')
+        cursor.execute('''INSERT INTO stats_counters (name, value)
+        SELECT 'active_users', COUNT(*) FROM users WHERE blocked = 0''')
+        cursor.execute('''INSERT INTO stats_counters (name, value)
+        SELECT 'requests_' || status, COUNT(*) FROM requests GROUP BY status''')
+        for name in ('requests_pending', 'requests_approved', 'requests_rejected'):
+            cursor.execute('INSERT OR IGNORE INTO stats_counters (name, value) VALUES (?, 0)', (name,))
+
+    def _migration_persistence(self, cursor):
+        # Состояния ConversationHandler и context.user_data, чтобы перезапуск не сбрасывал диалоги
+        cursor.execute('''CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT,
+            key TEXT,
+            state TEXT,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID''')
+        
+        cursor.execute('''CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT
+        )''')
+
+    def _migration_leases(self, cursor):
+        # Какой процесс сейчас ведёт рассылку или проверку блокировок
+        cursor.execute('''CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
+        ) WITHOUT ROWID''')
+
+    def _migration_link_hash(self, cursor):
+        self._add_column(cursor, 'requests', 'link_hash', 'INTEGER')
+        rows = cursor.execute('SELECT request_id, link FROM requests WHERE link_hash IS NULL').fetchall()
+        cursor.executemany(
+            'UPDATE requests SET link_hash = ? WHERE request_id = ?',
+            [(link_hash(row['link'] or ''), row['request_id']) for row in rows]
+        )
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_requests_link_hash
+        ON requests(link_hash, status)''')
+
+    def _migration_requests_archive(self, cursor):
+        # Время решения по старым заявкам неизвестно, считаем им время создания
+        self._add_column(cursor, 'requests', 'processed_at', 'TEXT')
+        cursor.execute('''UPDATE requests SET processed_at = created_at 
+        WHERE status != 'pending' AND processed_at IS NULL''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_requests_processed_at
+        ON requests(processed_at) WHERE processed_at IS NOT NULL''')
+        
+        cursor.execute('''CREATE TABLE IF NOT EXISTS requests_archive (
+            request_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            link TEXT,
+            summer_id TEXT,
+            status TEXT,
+            created_at TEXT,
+            processed_at TEXT,
+            link_hash INTEGER
+        )''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_requests_archive_link_hash
+        ON requests_archive(link_hash, status)''')
+
+    def _migration_username_index(self, cursor):
+        # Для массовой модерации по @username
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_users_username
+        ON users(username COLLATE NOCASE)''')
+
+    def _migration_broadcast_media(self, cursor):
+        # Рассылка копирует сообщение админа; file_id нужен, если исходное сообщение удалят
+        self._add_column(cursor, 'broadcast_jobs', 'content_type', "TEXT DEFAULT 'text'")
+        self._add_column(cursor, 'broadcast_jobs', 'file_id', 'TEXT')
+        self._add_column(cursor, 'broadcast_jobs', 'entities', 'TEXT')
+        self._add_column(cursor, 'broadcast_jobs', 'source_chat_id', 'INTEGER')
+        self._add_column(cursor, 'broadcast_jobs', 'source_message_id', 'INTEGER')
+
+    def _migration_broadcast_segments(self, cursor):
+        self._add_column(cursor, 'broadcast_jobs', 'segment', 'TEXT')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_users_lang
+        ON users(blocked, lang)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_requests_created_user
+        ON requests(created_at, user_id)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_requests_archive_created_user
+        ON requests_archive(created_at, user_id)''')
+
+    def _migration_user_activity(self, cursor):
+        cursor.execute('''CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            last_seen TEXT
+        )''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_user_activity_last_seen
+        ON user_activity(last_seen)''')
+        # dau - пользователи, проявившие активность за день; mau - за последние MAU_DAYS дней
+        self._add_column(cursor, 'daily_stats', 'dau', 'INTEGER DEFAULT 0')
+        cursor.execute("INSERT OR IGNORE INTO stats_counters (name, value) VALUES ('mau', 0)")
+
+    def _migration_link_hash_fragments(self, cursor):
+        # Раньше якорь отбрасывался у всех ссылок, и разные ссылки Mega получали один отпечаток
+        for table in ('requests', 'requests_archive'):
+            rows = cursor.execute(f"SELECT request_id, link FROM {table} WHERE link LIKE '%#%'").fetchall()
+            cursor.executemany(
+                f'UPDATE {table} SET link_hash = ? WHERE request_id = ?',
+                [(link_hash(row['link']), row['request_id']) for row in rows]
+            )
+
+    def _add_column(self, cursor, table, column, definition):
+        columns = [row['name'] for row in cursor.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def explain_query_plan(self, sql, params=()):
+        return [row['detail'] for row in self._query_plan(sql, params)]
+
+    def _query_plan(self, sql, params=()):
+        cursor = self._reader().cursor()
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return cursor.fetchall()
+
+    @staticmethod
+    def _plan_problems(plan):
+        # Таблица целиком, сортировка во временном B-дереве или вложенный цикл, который на каждую
+        # строку внешней таблицы перебирает диапазон или всю внутреннюю вместо поиска по ключу
+        problems = []
+        loops = {}
+        for row in plan:
+            step = row['detail']
+            if 'TEMP B-TREE' in step:
+                problems.append(step)
+            if not step.startswith(('SCAN', 'SEARCH')):
+                continue
+            # Соседние шаги с общим родителем - уровни одного вложенного цикла
+            depth = loops.get(row['parent'], 0)
+            loops[row['parent']] = depth + 1
+            if step.startswith('SCAN'):
+                if depth or 'INDEX' not in step:
+                    problems.append(step)
+            elif depth and not re.search(r'[^<>!]=', step):
+                problems.append(step)
+        return problems
+
+    def check_query_plans(self):
+        # Возвращает горячие запросы с подозрительными планами
+        problems = {}
+        for name, (sql, params) in HOT_QUERIES.items():
+            plan = self._query_plan(sql, params)
+            if self._plan_problems(plan):
+                problems[name] = [row['detail'] for row in plan]
+        return problems
+
+    @timed_query
     def get_user(self, user_id):
-        cursor = self.conn.cursor()
+        found, row = self.user_cache.get(user_id)
+        if found:
+            return row
+
+        version = self.user_cache.version()
+        cursor = self._reader().cursor()
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        return cursor.fetchone()
+        row = cursor.fetchone()
+        self.user_cache.set(user_id, row, version)
+        return row
 
+    @write_query
     def add_user(self, user_id, username, first_name, last_name, lang):
-        cursor = self.conn.cursor()
-        cursor.execute('''INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, lang) 
-        VALUES (?, ?, ?, ?, ?)''', (user_id, username, first_name, last_name, lang))
-        self.conn.commit()
+        def add(cursor):
+            cursor.execute('''INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, lang) 
+            VALUES (?, ?, ?, ?, ?)''', (user_id, username, first_name, last_name, lang))
+            if cursor.rowcount:
+                self._bump_daily(cursor, 'signups', 1)
+                self._bump_counter(cursor, 'active_users', 1)
+
+        return self._submit(add, after=lambda _: self.user_cache.invalidate([user_id]))
 
+    @write_query
     def update_user_lang(self, user_id, lang):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE users SET lang = ? WHERE user_id = ?', (lang, user_id))
-        self.conn.commit()
+        return self._submit(
+            lambda cursor: cursor.execute('UPDATE users SET lang = ? WHERE user_id = ?', (lang, user_id)),
+            after=lambda _: self.user_cache.invalidate([user_id])
+        )
 
+    @write_query
     def add_request(self, user_id, link, summer_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''INSERT INTO requests (user_id, link, summer_id) 
-        VALUES (?, ?, ?)''', (user_id, link, summer_id))
-        request_id = cursor.lastrowid
-        self.conn.commit()
-        return request_id
+        fingerprint = link_hash(link)
 
-    def get_pending_requests(self, page=0, per_page=10):
-        cursor = self.conn.cursor()
-        cursor.execute('''SELECT r.request_id, r.created_at, u.user_id, u.username 
-        FROM requests r
-        JOIN users u ON r.user_id = u.user_id
-        WHERE r.status = 'pending'
-        ORDER BY r.created_at DESC
-        LIMIT ? OFFSET ?''', (per_page, page * per_page))
-        return cursor.fetchall()
+        def add(cursor):
+            # Повторная проверка внутри транзакции: две одинаковые заявки могли прийти одновременно
+            if self._find_duplicate_request(cursor, fingerprint):
+                return None
+            cursor.execute('''INSERT INTO requests (user_id, link, summer_id, link_hash) 
+            VALUES (?, ?, ?, ?)''', (user_id, link, summer_id, fingerprint))
+            request_id = cursor.lastrowid
+            self._bump_daily(cursor, 'requests_created', 1)
+            self._bump_counter(cursor, 'requests_pending', 1)
+            return request_id
+
+        return self._submit(add)
+
+    @staticmethod
+    def _find_duplicate_request(cursor, fingerprint):
+        sql, _ = HOT_QUERIES['find_duplicate_request']
+        cursor.execute(sql, (fingerprint, fingerprint))
+        return cursor.fetchone()
+
+    @timed_query
+    def find_duplicate_request(self, link):
+        # Ожидающая или уже одобренная заявка с той же ссылкой
+        return self._find_duplicate_request(self._reader().cursor(), link_hash(link))
+
+    @timed_query
+    def get_pending_requests(self, direction=None, position=None, per_page=10):
+        # Постраничный вывод по ключу (created_at, request_id), новые заявки первыми.
+        # direction='older' - страница после position, 'newer' - перед ней
+        cursor = self._reader().cursor()
+        if direction not in ('newer', 'older'):
+            direction, position = 'first', ()
+        sql, _ = HOT_QUERIES[f'get_pending_requests_{direction}']
+        cursor.execute(sql, (*position, per_page + 1))
+        rows = cursor.fetchall()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if direction == 'newer':
+            rows.reverse()
+
+        if not rows:
+            return rows, False, False
+        first, last = rows[0], rows[-1]
+        has_newer = has_more if direction == 'newer' else self._has_pending_request('newer', first)
+        has_older = has_more if direction != 'newer' else self._has_pending_request('older', last)
+        return rows, has_newer, has_older
+
+    def _has_pending_request(self, direction, row):
+        cursor = self._reader().cursor()
+        sql, _ = HOT_QUERIES[f'has_pending_request_{direction}']
+        cursor.execute(sql, (row['created_at'], row['request_id']))
+        return cursor.fetchone() is not None
 
+    @timed_query
     def get_request(self, request_id):
-        cursor = self.conn.cursor()
+        cursor = self._reader().cursor()
         cursor.execute('''SELECT r.*, u.username 
         FROM requests r
         JOIN users u ON r.user_id = u.user_id
         WHERE r.request_id = ?''', (request_id,))
         return cursor.fetchone()
 
+    @write_query
     def update_request_status(self, request_id, status):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE requests SET status = ? WHERE request_id = ?', (status, request_id))
-        self.conn.commit()
+        def update(cursor):
+            cursor.execute('SELECT status, processed_at FROM requests WHERE request_id = ?', (request_id,))
+            row = cursor.fetchone()
+            if row is None or row['status'] == status:
+                return
+            if row['status'] in ('approved', 'rejected') and row['processed_at']:
+                # Пересмотренное решение списывается с того дня, когда было принято.
+                # Дни решений, принятых до появления статистики, неизвестны и не учтены
+                column = f"requests_{row['status']}"
+                cursor.execute(f'''UPDATE daily_stats SET {column} = {column} - 1 
+                WHERE day = date(?) AND {column} > 0''', (row['processed_at'],))
+            cursor.execute('''UPDATE requests SET status = ?, 
+            processed_at = CASE WHEN ? = 'pending' THEN NULL ELSE CURRENT_TIMESTAMP END 
+            WHERE request_id = ?''', (status, status, request_id))
+            self._bump_counter(cursor, f"requests_{row['status']}", -1)
+            self._bump_counter(cursor, f'requests_{status}', 1)
+            if status in ('approved', 'rejected'):
+                self._bump_daily(cursor, f'requests_{status}', 1)
+
+        return self._submit(update)
+
+    @timed_query
+    def find_user_by_username(self, username):
+        cursor = self._reader().cursor()
+        cursor.execute('SELECT * FROM users WHERE username = ? COLLATE NOCASE LIMIT 1', (username,))
+        return cursor.fetchone()
+
+    @staticmethod
+    def _pending_selection(selection):
+        # Выбор для массовой модерации: номера заявок со страницы, пользователь или часть ссылки
+        if 'ids' in selection:
+            return f"r.request_id IN ({','.join('?' * len(selection['ids']))})", list(selection['ids'])
+        if 'user_id' in selection:
+            return 'r.user_id = ?', [selection['user_id']]
+        pattern = selection['link'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return "r.link LIKE ? ESCAPE '\\'", [f'%{pattern}%']
+
+    @timed_query
+    def count_pending_selection(self, selection):
+        condition, params = self._pending_selection(selection)
+        cursor = self._reader().cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM requests r WHERE r.status = 'pending' AND {condition}", params)
+        return cursor.fetchone()[0]
+
+    @write_query
+    def bulk_update_request_status(self, selection, status):
+        # Все изменения одной транзакцией; возвращает решённые заявки с языком их авторов для уведомлений
+        condition, params = self._pending_selection(selection)
+
+        def update(cursor):
+            cursor.execute(f'''SELECT r.request_id, r.user_id, u.lang 
+            FROM requests r
+            LEFT JOIN users u ON r.user_id = u.user_id
+            WHERE r.status = 'pending' AND {condition}''', params)
+            rows = cursor.fetchall()
+            cursor.executemany('''UPDATE requests SET status = ?, processed_at = CURRENT_TIMESTAMP 
+            WHERE request_id = ? AND status = 'pending' ''', [(status, row['request_id']) for row in rows])
+            if rows:
+                self._bump_counter(cursor, 'requests_pending', -len(rows))
+                self._bump_counter(cursor, f'requests_{status}', len(rows))
+                self._bump_daily(cursor, f'requests_{status}', len(rows))
+            return rows
+
+        return self._submit(update)
+
+    @write_query
+    def archive_requests(self, older_than_days, limit=ARCHIVE_BATCH_SIZE):
+        # Переносит пачку давно обработанных заявок в архив. Счётчики статистики не меняются:
+        # в них и так учтены все заявки за всё время
+        def archive(cursor):
+            sql, _ = HOT_QUERIES['get_archivable_requests']
+            cursor.execute(sql, (f'-{older_than_days} days', limit))
+            params = [(row['request_id'],) for row in cursor.fetchall()]
+            cursor.executemany(f'''INSERT OR REPLACE INTO requests_archive ({REQUEST_COLUMNS})
+            SELECT {REQUEST_COLUMNS} FROM requests WHERE request_id = ?''', params)
+            cursor.executemany('DELETE FROM requests WHERE request_id = ?', params)
+            return len(params)
+
+        return self._submit(archive)
+
+    def iter_export(self, table):
+        # Отдельное соединение и fetchmany: память не зависит от размера таблицы
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(EXPORT_QUERIES[table])
+            yield [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            conn.close()
+
+    def _bump_daily(self, cursor, column, amount, day=None):
+        cursor.execute(f'''INSERT INTO daily_stats (day, {column}) VALUES (COALESCE(?, date('now')), ?)
+        ON CONFLICT(day) DO UPDATE SET {column} = {column} + excluded.{column}''', (day, amount))
 
+    def _bump_counter(self, cursor, name, amount):
+        cursor.execute('''INSERT INTO stats_counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value''', (name, amount))
+
+    def _block_users(self, cursor, user_ids):
+        params = [(user_id,) for user_id in user_ids]
+        # Сначала списываем регистрацию со дня, когда пользователь пришёл, пока он ещё не помечен
+        cursor.executemany('''UPDATE daily_stats SET signups = signups - 1
+        WHERE day = (SELECT date(created_at) FROM users WHERE user_id = ? AND blocked = 0)''', params)
+        cursor.executemany('UPDATE users SET blocked = 1 WHERE user_id = ? AND blocked = 0', params)
+        blocked = cursor.rowcount
+        if blocked > 0:
+            self._bump_daily(cursor, 'blocks', blocked)
+            self._bump_counter(cursor, 'active_users', -blocked)
+        return max(blocked, 0)
+
+    @timed_query
     def get_stats(self):
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''SELECT COUNT(*) FROM users 
-        WHERE date(created_at) = date('now') AND blocked = 0''')
-        today = cursor.fetchone()[0]
-        
-        cursor.execute('''SELECT COUNT(*) FROM users 
-        WHERE date(created_at) = date('now', '-1 day') AND blocked = 0''')
-        yesterday = cursor.fetchone()[0]
+        # Статистика собирается из счётчиков, поэтому не зависит от размера таблиц
+        snapshot = self._stats_snapshot
+        if snapshot is not None and snapshot[0] > time.monotonic():
+            return snapshot[1]
+
+        cursor = self._reader().cursor()
+        cursor.execute('SELECT name, value FROM stats_counters')
+        stats = {row['name']: row['value'] for row in cursor.fetchall()}
         
-        cursor.execute('SELECT COUNT(*) FROM users WHERE blocked = 0')
-        total = cursor.fetchone()[0]
+        sql, _ = HOT_QUERIES['get_stats_days']
+        cursor.execute(sql)
+        days = {row['day']: dict(row) for row in cursor.fetchall()}
+        cursor.execute("SELECT date('now'), date('now', '-1 day')")
+        today, yesterday = cursor.fetchone()
+        empty = {'signups': 0, 'blocks': 0, 'requests_created': 0, 'requests_approved': 0, 'requests_rejected': 0, 'dau': 0}
+        stats['today'] = days.get(today, empty)
+        stats['yesterday'] = days.get(yesterday, empty)
         
-        return today, yesterday, total
+        self._stats_snapshot = (time.monotonic() + STATS_CACHE_TTL, stats)
+        return stats
 
-    def get_all_active_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE blocked = 0')
+    @write_query
+    def record_activity(self, last_seen):
+        # last_seen: user_id -> время последнего обновления за период, одной пачкой
+        rows = sorted(last_seen.items())
+
+        def record(cursor):
+            # Первая активность пользователя за день увеличивает DAU этого дня
+            cursor.executemany('''INSERT INTO daily_stats (day, dau) SELECT date(?), 1
+            WHERE NOT EXISTS (SELECT 1 FROM user_activity WHERE user_id = ? AND last_seen >= date(?))
+            ON CONFLICT(day) DO UPDATE SET dau = dau + 1''', [(seen, user_id, seen) for user_id, seen in rows])
+            cursor.executemany('''INSERT INTO user_activity (user_id, last_seen) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET last_seen = max(last_seen, excluded.last_seen)''', rows)
+            # MAU пересчитывается по индексу last_seen, чтобы старые посещения выпадали из окна
+            cursor.execute(f'''INSERT INTO stats_counters (name, value)
+            SELECT 'mau', COUNT(*) FROM user_activity WHERE last_seen >= datetime('now', '-{MAU_DAYS} days')
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value''')
+
+        return self._submit(record)
+
+    @timed_query
+    def get_stale_users_chunk(self, recheck_hours, after_user_id, limit):
+        cursor = self._reader().cursor()
+        cursor.execute('''SELECT user_id FROM users 
+        WHERE blocked = 0 AND user_id > ?
+        AND (last_checked_at IS NULL OR last_checked_at < datetime('now', ?))
+        ORDER BY user_id LIMIT ?''', (after_user_id, f'-{recheck_hours} hours', limit))
         return [row[0] for row in cursor.fetchall()]
 
+    @write_query
+    def record_block_checks(self, results):
+        blocked_users = [user_id for user_id, status in results if status == 'blocked']
+
+        def record(cursor):
+            cursor.executemany('UPDATE users SET last_checked_at = CURRENT_TIMESTAMP WHERE user_id = ?',
+                               [(user_id,) for user_id, _ in results])
+            self._block_users(cursor, blocked_users)
+
+        return self._submit(record, after=lambda _: self._invalidate_blocked(blocked_users))
+
+    @write_query
     def mark_blocked_users(self, user_ids):
-        cursor = self.conn.cursor()
-        cursor.executemany('UPDATE users SET blocked = 1 WHERE user_id = ?', [(uid,) for uid in user_ids])
-        self.conn.commit()
-        return cursor.rowcount
+        return self._submit(
+            lambda cursor: self._block_users(cursor, user_ids),
+            after=lambda _: self.user_cache.invalidate(user_ids)
+        )
 
-    def add_broadcast_record(self, admin_id, message_text, total_users, success_count, failed_count):
-        cursor = self.conn.cursor()
-        cursor.execute('''INSERT INTO broadcast_history 
-        (admin_id, message_text, total_users, success_count, failed_count)
-        VALUES (?, ?, ?, ?, ?)''', (admin_id, message_text, total_users, success_count, failed_count))
-        self.conn.commit()
-        return cursor.lastrowid
+    def _invalidate_blocked(self, user_ids):
+        if user_ids:
+            self.user_cache.invalidate(user_ids)
+
+    @write_query
+    def create_broadcast_job(self, admin_id, status_chat_id, status_message_id, message_text,
+                             content_type='text', file_id=None, entities=None,
+                             source_chat_id=None, source_message_id=None, segment=None, draft=False):
+        # Черновик ждёт подтверждения админа и не мешает идущей рассылке
+        segment = segment or {'kind': 'all'}
+        segment_sql, segment_params = self._segment_query(segment)
+
+        def create(cursor):
+            if draft:
+                self._discard_broadcast_drafts(cursor, admin_id)
+            try:
+                cursor.execute('''INSERT INTO broadcast_jobs 
+                (admin_id, status_chat_id, status_message_id, message_text, 
+                content_type, file_id, entities, source_chat_id, source_message_id, segment, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
+                    admin_id, status_chat_id, status_message_id, message_text,
+                    content_type, file_id, json.dumps(entities or []), source_chat_id, source_message_id,
+                    json.dumps(segment), 'draft' if draft else 'running'
+                ))
+            except sqlite3.IntegrityError:
+                return None
+            job_id = cursor.lastrowid
+            # Список получателей фиксируется в момент создания рассылки
+            cursor.execute(
+                f'INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id) {segment_sql}',
+                [job_id if param is None else param for param in segment_params]
+            )
+            cursor.execute('UPDATE broadcast_jobs SET total_users = ? WHERE job_id = ?', (cursor.rowcount, job_id))
+            return job_id
+
+        return self._submit(create)
+
+    @staticmethod
+    def _segment_query(segment):
+        # None в параметрах - место для job_id
+        kind = segment['kind']
+        if kind == 'lang':
+            params = (None, segment['lang'])
+        elif kind == 'signup':
+            since = datetime.strptime(segment['since'], '%Y-%m-%d')
+            until = datetime.strptime(segment['until'], '%Y-%m-%d') + timedelta(days=1)
+            params = (None, since.strftime('%Y-%m-%d'), until.strftime('%Y-%m-%d'))
+        elif kind == 'requesters':
+            days = f"-{int(segment['days'])} days"
+            params = (None, days, days)
+        else:
+            kind, params = 'all', (None,)
+        sql, _ = HOT_QUERIES[f'segment_{kind}']
+        return sql, params
+
+    @staticmethod
+    def _discard_broadcast_drafts(cursor, admin_id):
+        cursor.execute('''DELETE FROM broadcast_deliveries WHERE job_id IN 
+        (SELECT job_id FROM broadcast_jobs WHERE admin_id = ? AND status = 'draft')''', (admin_id,))
+        cursor.execute("DELETE FROM broadcast_jobs WHERE admin_id = ? AND status = 'draft'", (admin_id,))
+
+    @write_query
+    def discard_broadcast_drafts(self, admin_id):
+        return self._submit(lambda cursor: self._discard_broadcast_drafts(cursor, admin_id))
+
+    @write_query
+    def start_broadcast_job(self, job_id, status_chat_id, status_message_id):
+        # None - уже идёт другая рассылка, False - черновика больше нет
+        def start(cursor):
+            try:
+                cursor.execute('''UPDATE broadcast_jobs SET status = 'running', created_at = CURRENT_TIMESTAMP,
+                status_chat_id = ?, status_message_id = ?
+                WHERE job_id = ? AND status = 'draft' ''', (status_chat_id, status_message_id, job_id))
+            except sqlite3.IntegrityError:
+                return None
+            return cursor.rowcount == 1
+
+        return self._submit(start)
+
+    @timed_query
+    def get_broadcast_job(self, job_id):
+        cursor = self._reader().cursor()
+        cursor.execute('SELECT * FROM broadcast_jobs WHERE job_id = ?', (job_id,))
+        return cursor.fetchone()
+
+    @timed_query
+    def get_running_broadcast_jobs(self):
+        cursor = self._reader().cursor()
+        cursor.execute("SELECT * FROM broadcast_jobs WHERE status = 'running'")
+        return cursor.fetchall()
+
+    @timed_query
+    def get_pending_deliveries_chunk(self, job_id, after_user_id, limit):
+        cursor = self._reader().cursor()
+        sql, _ = HOT_QUERIES['get_pending_deliveries_chunk']
+        cursor.execute(sql, (job_id, after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+    @write_query
+    def checkpoint_broadcast(self, job_id, results):
+        blocked_users = [user_id for user_id, status in results if status == 'blocked']
+
+        def checkpoint(cursor):
+            cursor.executemany('''UPDATE broadcast_deliveries SET status = ?, updated_at = CURRENT_TIMESTAMP 
+            WHERE job_id = ? AND user_id = ?''', [(status, job_id, user_id) for user_id, status in results])
+            self._block_users(cursor, blocked_users)
+
+        return self._submit(checkpoint, after=lambda _: self._invalidate_blocked(blocked_users))
+
+    @write_query
+    def finish_broadcast_job(self, job_id, status='done'):
+        def finish(cursor):
+            cursor.execute('''SELECT status, COUNT(*) FROM broadcast_deliveries 
+            WHERE job_id = ? GROUP BY status''', (job_id,))
+            counts = {'pending': 0, 'sent': 0, 'failed': 0, 'blocked': 0}
+            counts.update({row[0]: row[1] for row in cursor.fetchall()})
+
+            cursor.execute('''UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP 
+            WHERE job_id = ?''', (status, job_id))
+            cursor.execute('''INSERT INTO broadcast_history 
+            (admin_id, message_text, total_users, success_count, failed_count)
+            SELECT admin_id, message_text, total_users, ?, ? FROM broadcast_jobs WHERE job_id = ?''',
+            (counts['sent'], counts['failed'] + counts['blocked'], job_id))
+            return counts
+
+        return self._submit(finish)
+
+    @timed_query
+    def get_persisted_user_data(self):
+        cursor = self._reader().cursor()
+        cursor.execute('SELECT user_id, data FROM user_data')
+        return cursor.fetchall()
+
+    @timed_query
+    def get_persisted_conversations(self, name):
+        cursor = self._reader().cursor()
+        cursor.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+        return cursor.fetchall()
+
+    @write_query
+    def save_persistence(self, user_data, conversations):
+        # Значение None означает удаление записи
+        def save(cursor):
+            cursor.executemany(
+                'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                [(user_id, data) for user_id, data in user_data.items() if data is not None]
+            )
+            cursor.executemany(
+                'DELETE FROM user_data WHERE user_id = ?',
+                [(user_id,) for user_id, data in user_data.items() if data is None]
+            )
+            cursor.executemany(
+                'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+            )
+            cursor.executemany(
+                'DELETE FROM conversations WHERE name = ? AND key = ?',
+                [(name, key) for (name, key), state in conversations.items() if state is None]
+            )
+        return self._submit(save)
+
+    @write_query
+    def acquire_lease(self, name, owner, ttl):
+        # Захватывает свободную или просроченную аренду; владелец этим же вызовом продлевает свою
+        def acquire(cursor):
+            now = time.time()
+            cursor.execute('''INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?''', (name, owner, now + ttl, now))
+            return cursor.rowcount == 1
+        return self._submit(acquire)
+
+    @write_query
+    def release_lease(self, name, owner):
+        return self._submit(lambda cursor: cursor.execute(
+            'DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner)
+        ).rowcount)
 
     def close(self):
+        # Дожидаемся, пока писатель закоммитит всё, что уже в очереди
+        self._write_queue.put(None)
+        self._writer.join()
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
         self.conn.close()
 
+class AsyncDatabase:
+    # Выполняет чтения Database в отдельных потоках, чтобы не блокировать event loop.
+    # Записи ставятся в очередь писателя прямо из event loop: размер пачки зависит от нагрузки,
+    # а не от числа потоков, и чтения не ждут за потоками, занятыми ожиданием коммита
+    def __init__(self, database, max_workers=1):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        func = getattr(self._db, name)
+        submit = getattr(func, 'submit', None)
+
+        if submit is not None:
+            async def method(*args, **kwargs):
+                return await asyncio.wrap_future(submit(self._db, *args, **kwargs))
+        else:
+            async def method(*args, **kwargs):
+                return await self.run(func, *args, **kwargs)
+
+        setattr(self, name, method)
+        return method
+
+    async def _iter_chunks(self, fetch_chunk, chunk_size):
+        # Обход по ключу (user_id > последнего), в памяти только одна порция
+        after_user_id = 0
+        while True:
+            chunk = await self.run(fetch_chunk, after_user_id, chunk_size)
+            for user_id in chunk:
+                yield user_id
+            if len(chunk) < chunk_size:
+                return
+            after_user_id = chunk[-1]
+
+    def iter_pending_deliveries(self, job_id, chunk_size=USER_CHUNK_SIZE):
+        return self._iter_chunks(partial(self._db.get_pending_deliveries_chunk, job_id), chunk_size)
+
+    def iter_stale_users(self, recheck_hours, chunk_size=USER_CHUNK_SIZE):
+        return self._iter_chunks(partial(self._db.get_stale_users_chunk, recheck_hours), chunk_size)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
 # Инициализация базы данных
 db = Database()
+adb = AsyncDatabase(db, max_workers=DB_WORKERS)
 
 async def send_message_safe(bot, chat_id, text, parse_mode=None, reply_markup=None):
     try:
-        await bot.send_message(
+        return await outbound.call(
+            bot.send_message,
             chat_id=chat_id,
             text=text,
             parse_mode=parse_mode,
             reply_markup=reply_markup
         )
-        return True
-    except Exception as e:
+    except TelegramError as e:
         logger.error(f"Failed to send message to {chat_id}: {e}")
-        return False
-
-def get_main_menu_text(lang):
-    if lang == 'ru':
-        return (
-            "🤖 Этот бот создан для *бесплатного трейда*\\.\n\n"
-            "Если у вас есть *полезный цифровой товар* или *группа в Telegram*, вы можете отправить нам информацию о нём прямо здесь\\.\n\n"
-            "Если ваш товар окажется *рабочим и качественным*, вы получите *валюту внутри бота*\\. Размер вознаграждения зависит от того, *насколько ценным и полезным* будет ваш материал\\.\n\n"
-            "✅ *Допустимые форматы:*\n"
-            "• пиар\\-чаты\n"
-            "• приватные или открытые группы\n"
-            "• облачные хранилища с полезным контентом и др\\.\n\n"
-            "⚠️ *Отправка спама или мусора приведёт к бану во всех наших проектах\\.*\n\n"
-            "Нажмите кнопку ниже, чтобы отправить заявку и ознакомиться с инструкцией\\."
-        )
-    else:
-        return (
-            "🤖 This bot is created for *free trading*\\.\n\n"
-            "If you have a *useful digital item* or a *Telegram group*, you can submit it to us here\\.\n\n"
-            "If your submission is *working and of good quality*, you will receive *in\\-bot currency*\\. The amount depends on how *valuable and useful* your item is\\.\n\n"
-            "✅ *Acceptable formats:*\n"
-            "• promotion chats\n"
-            "• private or public groups\n"
-            "• cloud storage with useful content, etc\\.\n\n"
-            "⚠️ *Sending spam or trash content will lead to a ban from all our projects\\.*\n\n"
-            "Click the button below to submit your request and read the instructions\\."
+        return None
+
+class TokenBucket:
+    # Общий лимит исходящих запросов к Bot API
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        # После RetryAfter Telegram не примет ничего до конца паузы, останавливаем всех
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated_at = self._paused_until
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def parse_flood_limits(spec):
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        category, rule = item.split('=')
+        count, period = rule.split('/')
+        limits[category.strip()] = (float(count), float(period))
+    return limits
+
+class FloodControl:
+    # Токен-бакет на каждую пару (пользователь, категория); проверка без обращения к базе и без await
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}
+        self._pruned_at = time.monotonic()
+
+    def allow(self, user_id, category):
+        limit = self.limits.get(category)
+        if limit is None:
+            return True
+        capacity, period = limit
+        now = time.monotonic()
+        if now - self._pruned_at >= self.PRUNE_INTERVAL:
+            self._prune(now)
+        key = (user_id, category)
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * capacity / period)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def _prune(self, now):
+        # Бакет, который успел наполниться, ничем не отличается от отсутствующего
+        self._buckets = {
+            key: (tokens, updated_at) for key, (tokens, updated_at) in self._buckets.items()
+            if now - updated_at < self.limits[key[1]][1]
+        }
+        self._pruned_at = now
+
+    def __len__(self):
+        return len(self._buckets)
+
+class OutboundPipeline:
+    # Единая очередь всех исходящих запросов к Bot API: общий лимит, повторы и разбор ошибок по типу
+    def __init__(self, bucket, workers, max_retries):
+        self.bucket = bucket
+        self.workers = workers
+        self.max_retries = max_retries
+        self._queue = None
+        self._tasks = []
+        self._delayed = {}
+        self._in_flight = set()
+        self._sequence = itertools.count()
+
+    def _ensure_started(self):
+        if not self._tasks:
+            self._queue = asyncio.PriorityQueue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for handle, future in self._delayed.values():
+            handle.cancel()
+            future.cancel()
+        self._delayed.clear()
+        while self._queue is not None and not self._queue.empty():
+            self._queue.get_nowait()[-1].cancel()
+
+    def submit(self, method, *args, priority=PRIORITY_INTERACTIVE, mark_blocked=True, **kwargs):
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        chat_id = self._target_chat(method, kwargs) if mark_blocked else None
+        item = [priority, next(self._sequence), partial(method, *args, **kwargs), chat_id, 0, future]
+        self._queue.put_nowait(item)
+        return future
+
+    async def call(self, method, *args, **kwargs):
+        return await self.submit(method, *args, **kwargs)
+
+    def cancel(self, future):
+        # Запрос, который уже ушёл в Telegram или выполнен, отменить нельзя
+        if future in self._in_flight:
+            return False
+        return future.cancel()
+
+    @staticmethod
+    def _target_chat(method, kwargs):
+        if 'chat_id' in kwargs:
+            return kwargs['chat_id']
+        owner = getattr(method, '__self__', None)
+        if isinstance(owner, Message):
+            return owner.chat_id
+        if isinstance(owner, CallbackQuery) and owner.message:
+            return owner.message.chat_id
+        return None
+
+    def _retry_later(self, item, delay):
+        key = item[1]
+
+        def requeue():
+            self._delayed.pop(key, None)
+            self._queue.put_nowait(item)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._delayed[key] = (handle, item[-1])
+
+    @staticmethod
+    def _fail(future, error):
+        # Вызывающий мог перестать ждать, пока запрос был в полёте
+        if not future.done():
+            future.set_exception(error)
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            _, _, call, chat_id, attempt, future = item
+            await self.bucket.acquire()
+            # Пока ждали лимит, запрос могли отменить
+            if future.done():
+                continue
+            self._in_flight.add(future)
+            method = getattr(call.func, '__name__', 'unknown')
+            started = time.perf_counter()
+            try:
+                result = await call()
+            except RetryAfter as e:
+                metrics.inc('bot_api_errors_total', method=method, error='RetryAfter')
+                logger.warning(f"Flood control, pausing for {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+                self._queue.put_nowait(item)
+            except Forbidden as e:
+                if chat_id is not None and chat_id > 0:
+                    try:
+                        await adb.mark_blocked_users([chat_id])
+                    except Exception as db_error:
+                        logger.error(f"Failed to mark user {chat_id} as blocked: {db_error}")
+                self._fail(future, e)
+            except BadRequest as e:
+                # BadRequest наследует NetworkError, но повтор его не исправит
+                self._fail(future, e)
+            except NetworkError as e:
+                if attempt >= self.max_retries:
+                    self._fail(future, e)
+                else:
+                    metrics.inc('bot_api_errors_total', method=method, error=type(e).__name__)
+                    item[4] = attempt + 1
+                    delay = min(OUTBOUND_BACKOFF_BASE * 2 ** attempt, OUTBOUND_BACKOFF_MAX)
+                    logger.warning(f"Transient error, retry {attempt + 1} in {delay}s: {e}")
+                    self._retry_later(item, delay)
+            except Exception as e:
+                self._fail(future, e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._in_flight.discard(future)
+                metrics.observe('bot_api_call_seconds', time.perf_counter() - started, method=method)
+                error = future.exception() if future.done() and not future.cancelled() else None
+                if error is not None:
+                    metrics.inc('bot_api_errors_total', method=method, error=type(error).__name__)
+
+class BroadcastEngine:
+    # Рассылает по списку пользователей с ограниченной параллельностью через общую очередь
+    def __init__(self, name, pipeline, concurrency):
+        self.name = name
+        self.pipeline = pipeline
+        self.concurrency = concurrency
+
+    @staticmethod
+    def _status(future, user_id):
+        error = future.exception()
+        if error is None:
+            return 'sent'
+        if isinstance(error, Forbidden):
+            return 'blocked'
+        logger.error(f"Failed to deliver to {user_id}: {error}")
+        return 'failed'
+
+    async def run(self, user_ids, send, checkpoint):
+        counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+        pending = asyncio.Queue(maxsize=self.concurrency * 2)
+        results = []
+        flushed_at = time.monotonic()
+        flush_lock = asyncio.Lock()
+
+        async def flush():
+            nonlocal results, flushed_at
+            async with flush_lock:
+                batch, results = results, []
+                flushed_at = time.monotonic()
+                if not batch:
+                    return
+                write = asyncio.ensure_future(checkpoint(batch))
+                try:
+                    await asyncio.wait([write])
+                except asyncio.CancelledError:
+                    # Прогресс должен сохраниться и при остановке, иначе эти сообщения уйдут повторно
+                    await asyncio.wait([write])
+                    raise
+                write.result()
+
+        def record(user_id, status):
+            counts[status] += 1
+            results.append((user_id, status))
+            metrics.inc('bot_deliveries_total', engine=self.name, status=status)
+
+        async def worker():
+            while True:
+                user_id = await pending.get()
+                if user_id is None:
+                    return
+                # Блокировки сохраняет checkpoint пачкой, а не очередь по одной
+                future = self.pipeline.submit(send, user_id, priority=PRIORITY_BULK, mark_blocked=False)
+                try:
+                    await asyncio.wait([future])
+                except asyncio.CancelledError:
+                    if not self.pipeline.cancel(future):
+                        # Сообщение уже отправлено или отправляется: учитываем его, чтобы после перезапуска не отправить снова
+                        await asyncio.wait([future])
+                        record(user_id, self._status(future, user_id))
+                    raise
+                record(user_id, self._status(future, user_id))
+                if (len(results) >= BROADCAST_CHECKPOINT_SIZE
+                        or time.monotonic() - flushed_at >= BROADCAST_CHECKPOINT_INTERVAL):
+                    await flush()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            async for user_id in user_ids:
+                await pending.put(user_id)
+            for _ in workers:
+                await pending.put(None)
+            await asyncio.wait(workers)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.wait(workers)
+            # Даже при остановке сохраняем то, что уже успели отправить
+            await flush()
+        return counts
+
+rate_limiter = TokenBucket(GLOBAL_RATE_LIMIT)
+outbound = OutboundPipeline(rate_limiter, OUTBOUND_WORKERS, OUTBOUND_MAX_RETRIES)
+broadcast_engine = BroadcastEngine('broadcast', outbound, BROADCAST_CONCURRENCY)
+sweep_engine = BroadcastEngine('block_sweep', outbound, SWEEP_CONCURRENCY)
+flood_control = FloodControl(parse_flood_limits(FLOOD_LIMITS))
+
+class Lease:
+    # Аренда в базе гарантирует, что фоновую работу выполняет только один процесс.
+    # Пока работа идёт, аренда продлевается; если её перехватили, работа отменяется
+    held = set()
+
+    def __init__(self, name, ttl=LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._keepalive = None
+
+    async def acquire(self):
+        # Имя занимается до обращения к базе: для этого же процесса acquire_lease срабатывает как продление,
+        # и вторая задача, пришедшая во время ожидания, запустила бы ту же работу ещё раз
+        if self.name in Lease.held:
+            return False
+        Lease.held.add(self.name)
+        try:
+            acquired = await adb.acquire_lease(self.name, LEASE_OWNER, self.ttl)
+        except BaseException:
+            Lease.held.discard(self.name)
+            raise
+        if not acquired:
+            Lease.held.discard(self.name)
+            return False
+        self._keepalive = asyncio.create_task(self._renew(asyncio.current_task()))
+        return True
+
+    async def _renew(self, task):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                renewed = await adb.acquire_lease(self.name, LEASE_OWNER, self.ttl)
+            except Exception as e:
+                logger.error(f"Failed to renew lease {self.name}: {e}")
+                continue
+            if not renewed:
+                logger.error(f"Lease {self.name} was taken over, stopping")
+                Lease.held.discard(self.name)
+                task.cancel()
+                return
+
+    async def release(self):
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            await asyncio.wait([self._keepalive])
+            self._keepalive = None
+        Lease.held.discard(self.name)
+        await adb.release_lease(self.name, LEASE_OWNER)
+
+def start_background_task(coroutine):
+    # В отличие от Application.create_task, такие задачи не задерживают остановку бота
+    task = asyncio.create_task(coroutine)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+async def stop_background_tasks(application: Application) -> None:
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    # Очередь останавливаем последней: фоновые задачи могли дописывать в неё при отмене
+    await outbound.stop()
+
+metrics.gauge('bot_user_cache_hits', lambda: db.user_cache.stats()['hits'])
+metrics.gauge('bot_user_cache_misses', lambda: db.user_cache.stats()['misses'])
+metrics.gauge('bot_user_cache_size', lambda: db.user_cache.stats()['size'])
+metrics.gauge('bot_outbound_queue_size', lambda: outbound._queue.qsize() if outbound._queue is not None else 0)
+metrics.gauge('bot_outbound_in_flight', lambda: len(outbound._in_flight))
+metrics.gauge('bot_background_tasks', lambda: len(BACKGROUND_TASKS))
+metrics.gauge('bot_flood_tracked_buckets', lambda: len(flood_control))
+metrics_server = None
+
+async def serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[1] == '/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
         )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    global metrics_server
+    if METRICS_PORT:
+        # Только локальный адрес по умолчанию: метрики не предназначены для внешнего доступа
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+def format_request_notification(request):
+    return (
+        f"📩 *Новая заявка от пользователя:* @{request['username'] or 'N/A'}\n"
+        f"🔗 *Ссылка:* `{request['link']}`\n"
+        f"🆔 *Айди:* `{request['summer_id']}`"
+    )
+
+def request_decision_buttons(request_id, with_id=False):
+    suffix = f" #{request_id}" if with_id else ""
+    return [
+        InlineKeyboardButton(f"❌ Отклонить{suffix}", callback_data=f'reject_{request_id}'),
+        InlineKeyboardButton(f"✅ Принять{suffix}", callback_data=f'accept_{request_id}')
+    ]
+
+class AdminNotifier:
+    # Рассылает уведомления о заявках всем админам в фоне, по желанию собирая их в дайджест
+    def __init__(self, admin_ids, digest_window):
+        self.admin_ids = admin_ids
+        self.digest_window = digest_window
+        self._pending = []
+        self._flush_task = None
+
+    def notify(self, bot, request):
+        if self.digest_window <= 0:
+            reply_markup = InlineKeyboardMarkup([request_decision_buttons(request['request_id'])])
+            start_background_task(self._send(bot, format_request_notification(request), reply_markup))
+            return
+
+        self._pending.append(request)
+        if self._flush_task is None:
+            self._flush_task = start_background_task(self._flush_later(bot))
+
+    async def _flush_later(self, bot):
+        try:
+            await asyncio.sleep(self.digest_window)
+        finally:
+            # При остановке бота отправляем то, что успело накопиться
+            self._flush_task = None
+            batch, self._pending = self._pending, []
+            await self._send_digest(bot, batch)
+
+    async def _send_digest(self, bot, requests):
+        chunk, text = [], ""
+        for request in requests:
+            entry = (
+                f"*#{request['request_id']}* от @{request['username'] or 'N/A'}\n"
+                f"🔗 `{request['link']}`\n"
+                f"🆔 `{request['summer_id']}`\n\n"
+            )
+            if chunk and (len(text) + len(entry) > ADMIN_DIGEST_MAX_LENGTH or len(chunk) >= ADMIN_DIGEST_MAX_REQUESTS):
+                await self._send_digest_chunk(bot, chunk, text)
+                chunk, text = [], ""
+            chunk.append(request)
+            text += entry
+        if chunk:
+            await self._send_digest_chunk(bot, chunk, text)
+
+    async def _send_digest_chunk(self, bot, requests, text):
+        if len(requests) == 1:
+            await self._send(
+                bot,
+                format_request_notification(requests[0]),
+                InlineKeyboardMarkup([request_decision_buttons(requests[0]['request_id'])])
+            )
+            return
+        reply_markup = InlineKeyboardMarkup([
+            request_decision_buttons(request['request_id'], with_id=True) for request in requests
+        ])
+        await self._send(bot, f"📩 *Новые заявки: {len(requests)}*\n\n{text}", reply_markup)
+
+    async def _send(self, bot, text, reply_markup):
+        await asyncio.gather(*(
+            send_message_safe(bot, admin_id, text, reply_markup=reply_markup, parse_mode="Markdown")
+            for admin_id in self.admin_ids
+        ))
+
+admin_notifier = AdminNotifier(ADMIN_IDS, ADMIN_DIGEST_WINDOW)
 
+def load_catalog(path=LOCALES_DIR):
+    # Один файл на язык: locales/<код языка>.json, язык по умолчанию идёт первым
+    catalog = {}
+    for name in sorted(os.listdir(path), key=lambda name: (name != f'{DEFAULT_LANG}.json', name)):
+        if name.endswith('.json'):
+            with open(os.path.join(path, name), encoding='utf-8') as f:
+                catalog[name[:-len('.json')]] = json.load(f)
+    return catalog
+
+CATALOG = load_catalog()
+
+def t(lang, key):
+    messages = CATALOG.get(lang, CATALOG[DEFAULT_LANG])
+    return messages.get(key) or CATALOG[DEFAULT_LANG][key]
+
+def build_markups():
+    # Клавиатуры неизменяемы, поэтому собираем их один раз и переиспользуем
+    admin_menu = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')],
+        [InlineKeyboardButton("📨 Заявки", callback_data='admin_requests')],
+        [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast')],
+        [InlineKeyboardButton("🔄 Проверить блокировки", callback_data='admin_check_blocks')]
+    ])
+    markups = {
+        ('language', DEFAULT_LANG): InlineKeyboardMarkup([
+            [InlineKeyboardButton(messages['language_name'], callback_data=f'lang_{lang}')]
+            for lang, messages in CATALOG.items()
+        ]),
+        ('admin_menu', DEFAULT_LANG): admin_menu,
+        ('admin_stats', DEFAULT_LANG): InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Обновить", callback_data='admin_stats_refresh')],
+            [InlineKeyboardButton("🔙 Назад", callback_data='admin_back')]
+        ]),
+        ('admin_back', DEFAULT_LANG): InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад", callback_data='admin_back')]
+        ]),
+        ('admin_done', DEFAULT_LANG): InlineKeyboardMarkup([
+            [InlineKeyboardButton("👨‍💻 В меню", callback_data='admin_back')]
+        ]),
+        ('admin_broadcast', DEFAULT_LANG): InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад", callback_data='admin_back')],
+            [InlineKeyboardButton("❌ Отмена", callback_data='admin_cancel_broadcast')]
+        ]),
+        ('bulk_actions', DEFAULT_LANG): InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("✅ Одобрить все", callback_data='bulk_approved'),
+                InlineKeyboardButton("❌ Отклонить все", callback_data='bulk_rejected')
+            ],
+            [InlineKeyboardButton("🔙 Назад", callback_data='admin_back')]
+        ]),
+        ('broadcast_confirm', DEFAULT_LANG): InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Да, отправить", callback_data='broadcast_confirm_yes'),
+            InlineKeyboardButton("❌ Нет, отменить", callback_data='broadcast_confirm_no')
+        ]]),
+    }
+    markups[('broadcast_segments', DEFAULT_LANG)] = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("👥 Все активные", callback_data='segment_all')]]
+        + [[
+            InlineKeyboardButton(messages['language_name'], callback_data=f'segment_lang_{lang}')
+            for lang, messages in CATALOG.items()
+        ]]
+        + [
+            [
+                InlineKeyboardButton("📨 Заявки за 7 дней", callback_data='segment_requesters_7'),
+                InlineKeyboardButton("📨 За 30 дней", callback_data='segment_requesters_30')
+            ],
+            [InlineKeyboardButton("📅 По дате регистрации", callback_data='segment_signup')],
+            [InlineKeyboardButton("❌ Отмена", callback_data='admin_cancel_broadcast')]
+        ]
+    )
+    for lang in CATALOG:
+        markups[('main_menu', lang)] = InlineKeyboardMarkup([
+            [InlineKeyboardButton(t(lang, 'start_trade_button'), callback_data='start_trade')]
+        ])
+    return markups
+
+MARKUPS = build_markups()
+
+def get_markup(screen, lang=DEFAULT_LANG):
+    return MARKUPS.get((screen, lang)) or MARKUPS[(screen, DEFAULT_LANG)]
+
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    user_data = db.get_user(user.id)
+    user_data = await adb.get_user(user.id)
 
     if user_data and user_data['lang']:
         lang = user_data['lang']
         
-        text = get_main_menu_text(lang)
-        button_text = "🚀 Начать трейд" if lang == 'ru' else "🚀 Start Trade"
-        
-        keyboard = [[InlineKeyboardButton(button_text, callback_data='start_trade')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        text = t(lang, 'main_menu')
+        reply_markup = get_markup('main_menu', lang)
         
         if update.message:
-            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+            await outbound.call(update.message.reply_text, text, reply_markup=reply_markup, parse_mode='MarkdownV2')
         else:
             try:
-                await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+                await outbound.call(update.callback_query.edit_message_text, text, reply_markup=reply_markup, parse_mode='MarkdownV2')
             except:
                 await send_message_safe(context.bot, user.id, text, reply_markup=reply_markup, parse_mode='MarkdownV2')
         
         return TRADE
 
-    keyboard = [
-        [InlineKeyboardButton("🇷🇺 Русский", callback_data='lang_ru')],
-        [InlineKeyboardButton("🇬🇧 English", callback_data='lang_en')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_markup('language')
 
     text = "🌐 Выберите язык / Choose language"
     if update.message:
-        msg = await update.message.reply_text(text, reply_markup=reply_markup)
+        msg = await outbound.call(update.message.reply_text, text, reply_markup=reply_markup)
     else:
         try:
-            msg = await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+            msg = await outbound.call(update.callback_query.edit_message_text, text, reply_markup=reply_markup)
         except:
             msg = await send_message_safe(context.bot, user.id, text, reply_markup=reply_markup)
 
     context.user_data['lang_message_id'] = msg.message_id
     return LANGUAGE
 
+@instrument_handler
 async def language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -262,7 +1903,7 @@ async def language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = query.from_user
     lang = query.data.split('_')[1]
     
-    db.add_user(
+    await adb.add_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -270,14 +1911,11 @@ async def language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         lang=lang
     )
     
-    text = get_main_menu_text(lang)
-    button_text = "🚀 Начать трейд" if lang == 'ru' else "🚀 Start Trade"
-    
-    keyboard = [[InlineKeyboardButton(button_text, callback_data='start_trade')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text = t(lang, 'main_menu')
+    reply_markup = get_markup('main_menu', lang)
     
     try:
-        await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+        await outbound.call(query.edit_message_text, text=text, reply_markup=reply_markup, parse_mode='MarkdownV2')
     except Exception as e:
         logger.error(f"Error editing message: {e}")
         await send_message_safe(
@@ -290,74 +1928,59 @@ async def language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     return TRADE
 
+@instrument_handler
 async def start_trade(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    user_data = db.get_user(query.from_user.id)
+    user_data = await adb.get_user(query.from_user.id)
     lang = user_data['lang']
     
-    text = "📝 Пришлите сообщение в формате:\n🔗 Ссылка\n🆔 Ваш ID в Summer боте" if lang == 'ru' else "📝 Send message in format:\n🔗 Link\n🆔 Your Summer bot ID"
-    await query.edit_message_text(text=text)
+    await outbound.call(query.edit_message_text, text=t(lang, 'trade_instructions'))
     return TRADE
 
+@instrument_handler
 async def handle_trade_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    user_data = db.get_user(user.id)
+    user_data = await adb.get_user(user.id)
     lang = user_data['lang']
     message_text = update.message.text
 
     lines = message_text.split('\n')
     if len(lines) != 2 or not lines[0].strip() or not lines[1].strip():
-        error_text = (
-            "❌ *Неверный формат.* Пришлите:\n🔗 *Ссылка*\n🆔 *ID*"
-            if lang == 'ru'
-            else "❌ *Invalid format.* Send:\n🔗 *Link*\n🆔 *ID*"
-        )
-        await update.message.reply_text(error_text, parse_mode="Markdown")
+        await outbound.call(update.message.reply_text, t(lang, 'invalid_format'), parse_mode="Markdown")
         return TRADE
 
     link = lines[0].strip()
     summer_id = lines[1].strip()
-    request_id = db.add_request(user.id, link, summer_id)
+    # Дубликат не попадает в базу и не отвлекает админов
+    request_id = None
+    if not await adb.find_duplicate_request(link):
+        request_id = await adb.add_request(user.id, link, summer_id)
+    if request_id is None:
+        metrics.inc('bot_duplicate_requests_total')
+        await outbound.call(update.message.reply_text, t(lang, 'already_submitted'), parse_mode="Markdown")
+        return TRADE
 
-    success_text = "✅ *Заявка отправлена!*" if lang == 'ru' else "✅ *Request submitted!*"
-    await update.message.reply_text(success_text, parse_mode="Markdown")
+    await outbound.call(update.message.reply_text, t(lang, 'request_submitted'), parse_mode="Markdown")
 
-    admin_text = (
-        f"📩 *Новая заявка от пользователя:* @{user.username if user.username else 'N/A'}\n"
-        f"🔗 *Ссылка:* `{link}`\n"
-        f"🆔 *Айди:* `{summer_id}`"
-    )
+    # Пользователь не ждёт, пока админы получат уведомление
+    admin_notifier.notify(context.bot, {
+        'request_id': request_id,
+        'username': user.username,
+        'link': link,
+        'summer_id': summer_id
+    })
 
-    keyboard = [
-        [
-            InlineKeyboardButton("❌ Отклонить", callback_data=f'reject_{request_id}'),
-            InlineKeyboardButton("✅ Принять", callback_data=f'accept_{request_id}')
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    for admin_id in ADMIN_IDS:
-        await send_message_safe(
-            context.bot,
-            admin_id,
-            admin_text,
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
-        )
-
-    text = get_main_menu_text(lang)
-    keyboard = [[
-        InlineKeyboardButton(
-            "🚀 Начать трейд" if lang == 'ru' else "🚀 Start Trade",
-            callback_data='start_trade'
-        )
-    ]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="MarkdownV2")
+    await outbound.call(
+        update.message.reply_text,
+        t(lang, 'main_menu'),
+        reply_markup=get_markup('main_menu', lang),
+        parse_mode="MarkdownV2"
+    )
 
     return TRADE
 
+@instrument_handler
 async def handle_request_decision(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -369,13 +1992,13 @@ async def handle_request_decision(update: Update, context: ContextTypes.DEFAULT_
         logger.error(f"Error parsing callback data: {e}")
         return
     
-    request = db.get_request(request_id)
+    request = await adb.get_request(request_id)
     if not request:
         logger.error(f"Request not found: {request_id}")
         return
         
     user_id = request['user_id']
-    user_data = db.get_user(user_id)
+    user_data = await adb.get_user(user_id)
     if not user_data:
         logger.error(f"User not found: {user_id}")
         return
@@ -383,12 +2006,12 @@ async def handle_request_decision(update: Update, context: ContextTypes.DEFAULT_
     lang = user_data['lang']
     
     if action == 'accept':
-        db.update_request_status(request_id, 'approved')
-        user_text = "🎉 Ваша заявка одобрена!" if lang == 'ru' else "🎉 Request approved!"
+        await adb.update_request_status(request_id, 'approved')
+        user_text = t(lang, 'request_approved')
         admin_text = f"✅ Заявка {request_id} одобрена"
     elif action == 'reject':
-        db.update_request_status(request_id, 'rejected')
-        user_text = "😞 Заявка отклонена." if lang == 'ru' else "😞 Request rejected."
+        await adb.update_request_status(request_id, 'rejected')
+        user_text = t(lang, 'request_rejected')
         admin_text = f"❌ Заявка {request_id} отклонена"
     else:
         logger.error(f"Unknown action: {action}")
@@ -397,60 +2020,89 @@ async def handle_request_decision(update: Update, context: ContextTypes.DEFAULT_
     await send_message_safe(context.bot, user_id, user_text)
     
     try:
-        await query.edit_message_reply_markup(reply_markup=None)
-        await query.message.reply_text(admin_text)
+        # В дайджесте убираем только кнопки этой заявки
+        keyboard = []
+        if query.message.reply_markup:
+            keyboard = [
+                row for row in query.message.reply_markup.inline_keyboard
+                if not any(button.callback_data in (f'accept_{request_id}', f'reject_{request_id}') for button in row)
+            ]
+        await outbound.call(query.edit_message_reply_markup, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+        await outbound.call(query.message.reply_text, admin_text)
     except Exception as e:
         logger.error(f"Failed to update admin message: {e}")
 
+@instrument_handler
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     if user.id not in ADMIN_IDS:
-        await update.message.reply_text("⛔ У вас нет прав администратора.")
-        return ConversationHandler.END
+        await outbound.call(update.message.reply_text, "⛔ У вас нет прав администратора.")
+        # /admin - ещё и fallback диалога: обычный пользователь остаётся в текущем состоянии
+        return None
     
-    keyboard = [
-        [InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')],
-        [InlineKeyboardButton("📨 Заявки", callback_data='admin_requests')],
-        [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast')],
-        [InlineKeyboardButton("🔄 Проверить блокировки", callback_data='admin_check_blocks')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_markup('admin_menu')
     
     if update.message:
-        await update.message.reply_text("👨‍💻 Админ меню:", reply_markup=reply_markup)
+        await outbound.call(update.message.reply_text, "👨‍💻 Админ меню:", reply_markup=reply_markup)
     else:
         try:
-            await update.callback_query.edit_message_text("👨‍💻 Админ меню:", reply_markup=reply_markup)
+            await outbound.call(update.callback_query.edit_message_text, "👨‍💻 Админ меню:", reply_markup=reply_markup)
         except:
             await send_message_safe(context.bot, user.id, "👨‍💻 Админ меню:", reply_markup=reply_markup)
     
     return ADMIN_MAIN
 
+@instrument_handler
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     
-    today, yesterday, total = db.get_stats()
+    stats = await adb.get_stats()
+    today, yesterday = stats['today'], stats['yesterday']
+    mau = stats.get('mau', 0)
+    stickiness = f" (DAU/MAU {today['dau'] / mau:.0%})" if mau else ""
     text = (
         f"📊 Статистика\n\n"
-        f"🤖 Всего пользователей: {total}\n"
-        f"📅 Сегодня: {today}\n"
-        f"📅 Вчера: {yesterday}"
+        f"🤖 Всего пользователей: {stats.get('active_users', 0)}\n"
+        f"📅 Сегодня: {today['signups']}\n"
+        f"📅 Вчера: {yesterday['signups']}\n"
+        f"🚫 Заблокировали сегодня: {today['blocks']}\n\n"
+        f"👀 Активных сегодня: {today['dau']}{stickiness}\n"
+        f"👀 Активных вчера: {yesterday['dau']}\n"
+        f"📆 Активных за {MAU_DAYS} дней: {mau}\n\n"
+        f"📨 Заявки сегодня: {today['requests_created']} "
+        f"(✅ {today['requests_approved']} / ❌ {today['requests_rejected']})\n"
+        f"⏳ Ожидают решения: {stats.get('requests_pending', 0)}"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("🔄 Обновить", callback_data='admin_stats_refresh')],
-        [InlineKeyboardButton("🔙 Назад", callback_data='admin_back')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_markup('admin_stats')
     
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
+    await outbound.call(query.edit_message_text, text=text, reply_markup=reply_markup)
+
+def encode_request_position(row):
+    # В callback_data помещается не больше 64 байт, поэтому дату храним только цифрами
+    created_at = datetime.strptime(row['created_at'], '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H%M%S')
+    return f"{created_at}_{row['request_id']}"
+
+def decode_request_position(value):
+    created_at, request_id = value.split('_')
+    created_at = datetime.strptime(created_at, '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+    return created_at, int(request_id)
 
+@instrument_handler
 async def admin_requests(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     
-    requests = db.get_pending_requests()
+    direction, position = None, None
+    if query.data != 'admin_requests':
+        _, _, direction, value = query.data.split('_', 3)
+        direction = 'older' if direction == 'o' else 'newer'
+        position = decode_request_position(value)
+    
+    requests, has_newer, has_older = await adb.get_pending_requests(direction, position)
+    # Страница, которую видит админ, - выбор для кнопки «Выбрать страницу»
+    context.user_data['bulk_page'] = [req['request_id'] for req in requests]
     text = "📨 Ожидающие заявки:\n"
     if not requests:
         text += "Нет заявок"
@@ -460,172 +2112,567 @@ async def admin_requests(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             date_str = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M')
             text += f"\n/request_{request_id} - {date_str}"
     
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='admin_back')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Новее", callback_data=f'admin_requests_n_{encode_request_position(requests[0])}'
+        ))
+    if has_older:
+        navigation.append(InlineKeyboardButton(
+            "Старее ➡️", callback_data=f'admin_requests_o_{encode_request_position(requests[-1])}'
+        ))
+    
+    keyboard = [navigation] if navigation else []
+    if requests:
+        keyboard.append([
+            InlineKeyboardButton("☑️ Выбрать страницу", callback_data='bulk_page'),
+            InlineKeyboardButton("🔎 По фильтру", callback_data='bulk_filter')
+        ])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='admin_back')])
     
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
+    await outbound.call(query.edit_message_text, text=text, reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def show_bulk_selection(context, selection, send):
+    count = await adb.count_pending_selection(selection)
+    if not count:
+        context.user_data.pop('bulk_selection', None)
+        await outbound.call(send, "Нет ожидающих заявок по этому выбору", reply_markup=get_markup('admin_back'))
+        return
+    context.user_data['bulk_selection'] = selection
+    await outbound.call(send, f"☑️ Выбрано ожидающих заявок: {count}\n\nЧто с ними сделать?", reply_markup=get_markup('bulk_actions'))
+
+@instrument_handler
+async def bulk_select_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
+    await show_bulk_selection(context, {'ids': context.user_data.get('bulk_page', [])}, query.edit_message_text)
+    return ADMIN_MAIN
+
+@instrument_handler
+async def bulk_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    text = (
+        "🔎 Отправьте фильтр:\n\n"
+        "user 123456789 или user @username - все заявки пользователя\n"
+        "link t.me/+ - заявки, в ссылке которых есть этот текст"
+    )
+    await outbound.call(query.edit_message_text, text, reply_markup=get_markup('admin_back'))
+    return ADMIN_BULK_FILTER
+
+@instrument_handler
+async def bulk_filter_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    message = update.message
+    kind, _, value = message.text.strip().partition(' ')
+    kind, value = kind.lower(), value.strip()
+    
+    if kind == 'user' and value:
+        if value.lstrip('-').isdigit():
+            selection = {'user_id': int(value)}
+        else:
+            user = await adb.find_user_by_username(value.lstrip('@'))
+            if user is None:
+                await outbound.call(message.reply_text, "❌ Пользователь не найден", reply_markup=get_markup('admin_back'))
+                return ADMIN_BULK_FILTER
+            selection = {'user_id': user['user_id']}
+    elif kind == 'link' and value:
+        selection = {'link': value}
+    else:
+        await outbound.call(message.reply_text, "❌ Неверный фильтр. Пример: user @username или link t.me/+", reply_markup=get_markup('admin_back'))
+        return ADMIN_BULK_FILTER
+    
+    await show_bulk_selection(context, selection, message.reply_text)
+    return ADMIN_MAIN
+
+@instrument_handler
+async def bulk_apply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    selection = context.user_data.pop('bulk_selection', None)
+    if selection is None:
+        await outbound.call(query.edit_message_text, "⚠️ Выбор устарел, выберите заявки заново", reply_markup=get_markup('admin_back'))
+        return ADMIN_MAIN
     
-    text = "📢 Рассылка сообщений\n\nОтправьте сообщение, которое нужно разослать всем пользователям:"
-    keyboard = [
-        [InlineKeyboardButton("🔙 Назад", callback_data='admin_back')],
-        [InlineKeyboardButton("❌ Отмена", callback_data='admin_cancel_broadcast')]
+    status = query.data.split('_', 1)[1]
+    rows = await adb.bulk_update_request_status(selection, status)
+    verb = "Одобрено" if status == 'approved' else "Отклонено"
+    await outbound.call(query.edit_message_text, f"⏳ {verb} заявок: {len(rows)}. Отправляю уведомления пользователям...")
+    # Уведомления идут в фоне через общую очередь с лимитом
+    start_background_task(notify_bulk_decision(
+        context.bot, rows, status, verb, query.message.chat_id, query.message.message_id
+    ))
+    return ADMIN_MAIN
+
+async def notify_bulk_decision(bot, rows, status, verb, chat_id, message_id):
+    key = 'request_approved' if status == 'approved' else 'request_rejected'
+    # Одно уведомление на пользователя, даже если решено несколько его заявок
+    recipients = {row['user_id']: row['lang'] or DEFAULT_LANG for row in rows}
+    futures = [
+        outbound.submit(bot.send_message, chat_id=user_id, text=t(lang, key), priority=PRIORITY_BULK)
+        for user_id, lang in recipients.items()
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    
+    text = (
+        f"{'✅' if status == 'approved' else '❌'} {verb} заявок: {len(rows)}\n"
+        f"📨 Уведомлено пользователей: {len(recipients) - failed}"
+    )
+    if failed:
+        text += f"\n⚠️ Не доставлено: {failed}"
+    try:
+        await outbound.call(bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, reply_markup=get_markup('admin_done'))
+    except TelegramError as e:
+        logger.warning(f"Failed to report bulk moderation result: {e}")
+
+@instrument_handler
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    
+    text = "📢 Рассылка сообщений\n\nОтправьте сообщение, которое нужно разослать всем пользователям (текст, фото, видео, документ):"
+    reply_markup = get_markup('admin_broadcast')
     
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
+    await outbound.call(query.edit_message_text, text=text, reply_markup=reply_markup)
     return ADMIN_BROADCAST
 
-async def admin_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@instrument_handler
+async def admin_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     message = update.message
-    context.user_data['broadcast_message'] = message.text
+    payload = broadcast_payload(message)
+    if payload is None:
+        await outbound.call(message.reply_text, "❌ Такие сообщения рассылать нельзя. Отправьте текст, фото, видео или документ.")
+        return ADMIN_BROADCAST
+    context.user_data['broadcast_message'] = payload
     
-    user_count = len(db.get_all_active_users())
+    await outbound.call(message.reply_text, "👥 Кому отправить рассылку?", reply_markup=get_markup('broadcast_segments'))
+    return ADMIN_BROADCAST_SEGMENT
+
+def describe_segment(segment):
+    kind = segment['kind']
+    if kind == 'lang':
+        return f"язык {t(segment['lang'], 'language_name')}"
+    if kind == 'signup':
+        return f"зарегистрированные с {segment['since']} по {segment['until']}"
+    if kind == 'requesters':
+        return f"отправлявшие заявки за {segment['days']} дн."
+    return "все активные пользователи"
+
+@instrument_handler
+async def admin_broadcast_segment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    parts = query.data.split('_')
+    if parts[1] == 'signup':
+        text = "📅 Отправьте период регистрации в формате ГГГГ-ММ-ДД ГГГГ-ММ-ДД (включительно):"
+        await outbound.call(query.edit_message_text, text, reply_markup=get_markup('admin_broadcast'))
+        return ADMIN_BROADCAST_SEGMENT
+    if parts[1] == 'lang':
+        segment = {'kind': 'lang', 'lang': parts[2]}
+    elif parts[1] == 'requesters':
+        segment = {'kind': 'requesters', 'days': int(parts[2])}
+    else:
+        segment = {'kind': 'all'}
+    return await admin_broadcast_confirm(update, context, segment, query.edit_message_text)
+
+@instrument_handler
+async def admin_broadcast_signup_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    message = update.message
+    try:
+        since, until = (datetime.strptime(value, '%Y-%m-%d') for value in message.text.split())
+        if since > until:
+            raise ValueError
+    except ValueError:
+        await outbound.call(message.reply_text, "❌ Неверный период. Пример: 2024-01-01 2024-01-31")
+        return ADMIN_BROADCAST_SEGMENT
+    # strptime принимает и 2024-1-5, а created_at сравнивается как строка: храним даты в каноническом виде
+    segment = {'kind': 'signup', 'since': since.strftime('%Y-%m-%d'), 'until': until.strftime('%Y-%m-%d')}
+    return await admin_broadcast_confirm(update, context, segment, message.reply_text)
+
+async def admin_broadcast_confirm(update, context, segment, send):
+    # Получатели сохраняются в черновик сразу: подтверждение и сама рассылка читают один и тот же снимок
+    payload = context.user_data.get('broadcast_message')
+    if payload is None:
+        await outbound.call(send, "⚠️ Сообщение для рассылки потеряно, начните заново", reply_markup=get_markup('admin_back'))
+        return ADMIN_MAIN
+    admin_id = update.effective_user.id
+    job_id = await adb.create_broadcast_job(
+        admin_id=admin_id,
+        status_chat_id=admin_id,
+        status_message_id=None,
+        message_text=payload['text'],
+        content_type=payload['content_type'],
+        file_id=payload['file_id'],
+        entities=payload['entities'],
+        source_chat_id=payload['chat_id'],
+        source_message_id=payload['message_id'],
+        segment=segment,
+        draft=True
+    )
+    job = await adb.get_broadcast_job(job_id)
+    context.user_data['broadcast_job_id'] = job_id
+    
+    attachment = '' if payload['content_type'] == 'text' else f"[{payload['content_type']}] "
     text = (
         f"📢 Подтверждение рассылки\n\n"
-        f"Сообщение:\n{message.text}\n\n"
-        f"Будет отправлено: {user_count} пользователям\n\n"
+        f"Сообщение:\n{attachment}{payload['text']}\n\n"
+        f"Получатели: {describe_segment(segment)}\n"
+        f"Будет отправлено: {job['total_users']} пользователям\n\n"
         f"Подтверждаете?"
     )
     
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Да, отправить", callback_data='broadcast_confirm_yes'),
-            InlineKeyboardButton("❌ Нет, отменить", callback_data='broadcast_confirm_no')
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_markup('broadcast_confirm')
     
-    await message.reply_text(text, reply_markup=reply_markup)
+    await outbound.call(send, text, reply_markup=reply_markup)
     return ADMIN_BROADCAST_CONFIRM
 
+@instrument_handler
 async def admin_broadcast_execute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     
-    if not BROADCAST_LOCK.acquire(blocking=False):
-        await query.edit_message_text("⏳ Рассылка уже выполняется, пожалуйста, подождите...")
-        return
-    
     try:
-        broadcast_text = context.user_data['broadcast_message']
-        user_ids = db.get_all_active_users()
-        total_users = len(user_ids)
-        success = 0
-        failed = 0
-        blocked_users = []
-
-        await query.edit_message_text(f"⏳ Начата рассылка сообщения для {total_users} пользователей...")
-
-        for i, user_id in enumerate(user_ids):
-            if i % 20 == 0 and i > 0:
-                time.sleep(1)
-            
+        job_id = context.user_data.get('broadcast_job_id')
+        started = await adb.start_broadcast_job(job_id, query.message.chat_id, query.message.message_id)
+        if started is None:
+            await outbound.call(query.edit_message_text, "⏳ Рассылка уже выполняется, пожалуйста, подождите...")
+            return ADMIN_MAIN
+        if not started:
+            await outbound.call(query.edit_message_text, "⚠️ Черновик рассылки устарел, начните заново", reply_markup=get_markup('admin_back'))
+            return ADMIN_MAIN
+        context.user_data.pop('broadcast_job_id', None)
+        context.user_data.pop('broadcast_message', None)
+
+        job = await adb.get_broadcast_job(job_id)
+        await outbound.call(query.edit_message_text, f"⏳ Начата рассылка сообщения для {job['total_users']} пользователей...")
+        # Рассылка идёт в фоне, бот продолжает отвечать остальным
+        start_background_task(run_broadcast(context.bot, job))
+    except Exception as e:
+        logger.error(f"Ошибка при рассылке: {e}")
+        await outbound.call(query.edit_message_text, f"❌ Произошла ошибка при рассылке: {str(e)}")
+
+    return ADMIN_MAIN
+
+# Тип вложения -> метод Bot API и имя параметра для отправки по file_id
+MEDIA_SENDERS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'animation': ('send_animation', 'animation'),
+    'document': ('send_document', 'document'),
+    'audio': ('send_audio', 'audio'),
+    'voice': ('send_voice', 'voice'),
+}
+
+def broadcast_payload(message):
+    # Всё, что нужно для рассылки, без самого файла: он уже лежит на серверах Telegram
+    content_type, file_id = 'text', None
+    for kind in MEDIA_SENDERS:
+        media = getattr(message, kind)
+        if media:
+            content_type = kind
+            file_id = (media[-1] if kind == 'photo' else media).file_id
+            break
+    if content_type == 'text' and not message.text:
+        return None
+    entities = message.entities if content_type == 'text' else message.caption_entities
+    return {
+        'content_type': content_type,
+        'file_id': file_id,
+        'text': message.text or message.caption or '',
+        'entities': [entity.to_dict() for entity in entities],
+        'chat_id': message.chat_id,
+        'message_id': message.message_id,
+    }
+
+def broadcast_sender(bot, job):
+    # copy_message пересылает сообщение админа с форматированием и вложением без повторной загрузки.
+    # Если админ удалил исходное сообщение, остаток рассылки идёт по сохранённому file_id
+    entities = [MessageEntity.de_json(entity, bot) for entity in json.loads(job['entities'] or '[]')]
+    state = {'copy': job['source_message_id'] is not None}
+
+    async def send_broadcast(user_id):
+        if state['copy']:
             try:
-                await context.bot.send_message(chat_id=user_id, text=broadcast_text)
-                success += 1
-            except Exception as e:
-                if "bot was blocked by the user" in str(e).lower():
-                    blocked_users.append(user_id)
-                failed += 1
-
-        if blocked_users:
-            db.mark_blocked_users(blocked_users)
-
-        db.add_broadcast_record(
-            admin_id=query.from_user.id,
-            message_text=broadcast_text,
-            total_users=total_users,
-            success_count=success,
-            failed_count=failed
+                return await bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=job['source_chat_id'],
+                    message_id=job['source_message_id']
+                )
+            except BadRequest as e:
+                if 'not found' not in str(e).lower():
+                    raise
+                logger.warning(f"Broadcast {job['job_id']} source message is gone, sending by file_id")
+                state['copy'] = False
+        if job['content_type'] == 'text':
+            return await bot.send_message(chat_id=user_id, text=job['message_text'], entities=entities or None)
+        method, argument = MEDIA_SENDERS[job['content_type']]
+        return await getattr(bot, method)(
+            chat_id=user_id,
+            caption=job['message_text'] or None,
+            caption_entities=entities or None,
+            **{argument: job['file_id']}
+        )
+
+    return send_broadcast
+
+async def run_broadcast(bot, job):
+    job_id = job['job_id']
+    lease = Lease(f'broadcast:{job_id}')
+    if not await lease.acquire():
+        return
+    try:
+        # Пока ждали аренду, рассылку мог закончить другой процесс
+        job = await adb.get_broadcast_job(job_id)
+        if job['status'] != 'running':
+            return
+        logger.info(f"Рассылка {job_id} выполняется процессом {LEASE_OWNER}")
+        await broadcast_engine.run(
+            adb.iter_pending_deliveries(job_id),
+            broadcast_sender(bot, job),
+            lambda results: adb.checkpoint_broadcast(job_id, results)
         )
+        counts = await adb.finish_broadcast_job(job_id)
 
         result_text = (
             f"📢 Результаты рассылки:\n"
-            f"✅ Успешно: {success}\n"
-            f"❌ Не удалось: {failed}\n"
-            f"🚫 Заблокировавших пользователей: {len(blocked_users)}"
+            f"✅ Успешно: {counts['sent']}\n"
+            f"❌ Не удалось: {counts['failed'] + counts['blocked']}\n"
+            f"🚫 Заблокировавших пользователей: {counts['blocked']}"
         )
         
-        keyboard = [[InlineKeyboardButton("👨‍💻 В меню", callback_data='admin_back')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(result_text, reply_markup=reply_markup)
+        reply_markup = get_markup('admin_done')
         
+        await outbound.call(
+            bot.edit_message_text,
+            result_text,
+            chat_id=job['status_chat_id'],
+            message_id=job['status_message_id'],
+            reply_markup=reply_markup
+        )
+
+    except asyncio.CancelledError:
+        logger.info(f"Рассылка {job_id} приостановлена, продолжится после перезапуска")
+        raise
     except Exception as e:
         logger.error(f"Ошибка при рассылке: {e}")
-        await query.edit_message_text(f"❌ Произошла ошибка при рассылке: {str(e)}")
+        await adb.finish_broadcast_job(job_id, status='failed')
+        await send_message_safe(bot, job['admin_id'], f"❌ Произошла ошибка при рассылке: {str(e)}")
     finally:
-        BROADCAST_LOCK.release()
-        return ADMIN_MAIN
+        await lease.release()
 
+async def watch_broadcasts(bot):
+    # Подхватывает незавершённые рассылки после перезапуска или если ведущий их процесс упал
+    while True:
+        try:
+            for job in await adb.get_running_broadcast_jobs():
+                if f"broadcast:{job['job_id']}" not in Lease.held:
+                    start_background_task(run_broadcast(bot, job))
+        except Exception as e:
+            logger.error(f"Failed to check running broadcasts: {e}")
+        await asyncio.sleep(LEASE_TTL)
+
+async def run_archiver():
+    # Архивирует в одном процессе за раз; пачки небольшие, чтобы не задерживать другие записи
+    while True:
+        lease = Lease('archiver')
+        if await lease.acquire():
+            try:
+                archived = 0
+                while True:
+                    count = await adb.archive_requests(ARCHIVE_AFTER_DAYS)
+                    archived += count
+                    if count < ARCHIVE_BATCH_SIZE:
+                        break
+                if archived:
+                    logger.info(f"Archived {archived} processed requests")
+            except Exception as e:
+                logger.error(f"Failed to archive requests: {e}")
+            finally:
+                await lease.release()
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+async def on_startup(application: Application) -> None:
+    await start_metrics_server()
+    start_background_task(watch_broadcasts(application.bot))
+    start_background_task(activity_tracker.run())
+    if ARCHIVE_AFTER_DAYS:
+        start_background_task(run_archiver())
+
+async def on_shutdown(application: Application) -> None:
+    await stop_background_tasks(application)
+    try:
+        await activity_tracker.flush()
+    except Exception as e:
+        logger.error(f"Failed to save user activity: {e}")
+    await stop_metrics_server()
+
+@instrument_handler
 async def admin_check_blocks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     
-    await query.edit_message_text("⏳ Проверяю заблокировавших пользователей...")
-    
-    user_ids = db.get_all_active_users()
-    blocked_users = []
-    
-    for user_id in user_ids:
-        try:
-            await context.bot.send_chat_action(chat_id=user_id, action='typing')
-        except Exception as e:
-            if "bot was blocked by the user" in str(e).lower():
-                blocked_users.append(user_id)
-    
-    if blocked_users:
-        db.mark_blocked_users(blocked_users)
-        text = f"🔍 Найдено {len(blocked_users)} заблокировавших пользователей"
-    else:
-        text = "✅ Все пользователи активны"
-    
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='admin_back')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    await outbound.call(query.edit_message_text, "⏳ Проверяю заблокировавших пользователей...")
+    # Проверка идёт в фоне, админ может пользоваться ботом
+    start_background_task(run_block_sweep(context.bot, query.message.chat_id, query.message.message_id))
+
+async def run_block_sweep(bot, chat_id, message_id):
+    # Проверку могли запустить и в другом процессе
+    lease = Lease('block_sweep')
+    if not await lease.acquire():
+        await outbound.call(
+            bot.edit_message_text,
+            "⏳ Проверка уже выполняется, пожалуйста, подождите...",
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=get_markup('admin_back')
+        )
+        return
+
+    progress = {'checked': 0, 'blocked': 0}
+    reported_at = time.monotonic()
 
+    async def checkpoint(results):
+        nonlocal reported_at
+        await adb.record_block_checks(results)
+        progress['checked'] += len(results)
+        progress['blocked'] += sum(1 for _, status in results if status == 'blocked')
+
+        if time.monotonic() - reported_at >= SWEEP_PROGRESS_INTERVAL:
+            reported_at = time.monotonic()
+            try:
+                await outbound.call(
+                    bot.edit_message_text,
+                    f"⏳ Проверено: {progress['checked']}, заблокировавших: {progress['blocked']}",
+                    chat_id=chat_id,
+                    message_id=message_id
+                )
+            except TelegramError as e:
+                logger.warning(f"Failed to update sweep progress: {e}")
+
+    try:
+        await sweep_engine.run(
+            adb.iter_stale_users(SWEEP_RECHECK_HOURS),
+            partial(bot.send_chat_action, action='typing'),
+            checkpoint
+        )
+
+        if progress['blocked']:
+            text = f"🔍 Найдено {progress['blocked']} заблокировавших пользователей"
+        else:
+            text = "✅ Все пользователи активны"
+        text += f"\nПроверено: {progress['checked']}"
+        
+        reply_markup = get_markup('admin_back')
+        
+        await outbound.call(bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при проверке блокировок: {e}")
+        await send_message_safe(bot, chat_id, f"❌ Произошла ошибка при проверке: {str(e)}")
+    finally:
+        await lease.release()
+
+async def discard_broadcast_draft(context, admin_id):
+    if context.user_data.pop('broadcast_job_id', None) is not None:
+        await adb.discard_broadcast_drafts(admin_id)
+
+@instrument_handler
 async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
+    # «Назад» с экранов рассылки не должен оставлять черновик со снимком получателей
+    await discard_broadcast_draft(context, query.from_user.id)
     
-    keyboard = [
-        [InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')],
-        [InlineKeyboardButton("📨 Заявки", callback_data='admin_requests')],
-        [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast')],
-        [InlineKeyboardButton("🔄 Проверить блокировки", callback_data='admin_check_blocks')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_markup('admin_menu')
     
-    await query.edit_message_text(text="👨‍💻 Админ меню:", reply_markup=reply_markup)
+    await outbound.call(query.edit_message_text, text="👨‍💻 Админ меню:", reply_markup=reply_markup)
     return ADMIN_MAIN
 
+@instrument_handler
 async def admin_cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     
     if 'broadcast_message' in context.user_data:
         del context.user_data['broadcast_message']
+    await discard_broadcast_draft(context, query.from_user.id)
     
-    keyboard = [
-        [InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')],
-        [InlineKeyboardButton("📨 Заявки", callback_data='admin_requests')],
-        [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast')],
-        [InlineKeyboardButton("🔄 Проверить блокировки", callback_data='admin_check_blocks')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_markup('admin_menu')
     
-    await query.edit_message_text(text="👨‍💻 Админ меню:", reply_markup=reply_markup)
+    await outbound.call(query.edit_message_text, text="👨‍💻 Админ меню:", reply_markup=reply_markup)
     return ADMIN_MAIN
 
+@instrument_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text('❌ Действие отменено.')
+    await outbound.call(update.message.reply_text, '❌ Действие отменено.')
     return ConversationHandler.END
 
+class ActivityTracker:
+    # Время последней активности копится в памяти и пишется в базу пачкой раз в ACTIVITY_FLUSH_INTERVAL,
+    # а не отдельной записью на каждое обновление
+    def __init__(self):
+        self._last_seen = {}
+
+    def touch(self, user_id):
+        self._last_seen[user_id] = time.time()
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    async def flush(self):
+        last_seen, self._last_seen = self._last_seen, {}
+        try:
+            await adb.record_activity({
+                user_id: time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seen)) for user_id, seen in last_seen.items()
+            })
+        except Exception:
+            # Более свежие отметки, пришедшие во время записи, не перезаписываем
+            for user_id, seen in last_seen.items():
+                self._last_seen.setdefault(user_id, seen)
+            raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to save user activity: {e}")
+
+activity_tracker = ActivityTracker()
+metrics.gauge('bot_activity_unsaved_users', lambda: len(activity_tracker))
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user:
+        activity_tracker.touch(update.effective_user.id)
+
+def update_category(update: Update):
+    if update.callback_query:
+        return 'callback'
+    message = update.message
+    if message is None:
+        return None
+    if message.text and message.text.startswith('/'):
+        return 'command'
+    return 'message'
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Выполняется раньше всех обработчиков; лишние обновления отбрасываются до обращения к базе
+    user = update.effective_user
+    if user is None or user.id in ADMIN_IDS:
+        return
+    category = update_category(update)
+    if category is None:
+        return
+    if not flood_control.allow(user.id, category):
+        metrics.inc('bot_flood_dropped_total', category=category)
+        raise ApplicationHandlerStop
+    metrics.inc('bot_flood_passed_total', category=category)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Exception while handling an update:", exc_info=context.error)
     if update and update.effective_user:
@@ -635,14 +2682,173 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             "⚠️ Произошла ошибка. Пожалуйста, попробуйте еще раз."
         )
 
-def main() -> None:
-    application = Application.builder().token(TOKEN).build()
+class SQLitePersistence(BasePersistence):
+    # Хранит состояния диалогов и user_data в основной базе. Записываются только изменившиеся
+    # записи, одной транзакцией на каждый проход Application.update_persistence
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._saved_user_data = {}
+        self._saved_conversations = {}
+        self._dirty_user_data = {}
+        self._dirty_conversations = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    @staticmethod
+    def _dump(value):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+    async def get_user_data(self):
+        user_data = {}
+        for row in await adb.get_persisted_user_data():
+            self._saved_user_data[row['user_id']] = row['data']
+            user_data[row['user_id']] = json.loads(row['data'])
+        return user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        conversations = {}
+        for row in await adb.get_persisted_conversations(name):
+            self._saved_conversations[(name, row['key'])] = row['state']
+            conversations[tuple(json.loads(row['key']))] = json.loads(row['state'])
+        return conversations
+
+    async def update_user_data(self, user_id, data):
+        # Application передаёт всех пользователей, получивших обновления, даже если данные не менялись
+        self._mark_dirty(self._saved_user_data, self._dirty_user_data, user_id, self._dump(data) if data else None)
+
+    async def drop_user_data(self, user_id):
+        self._mark_dirty(self._saved_user_data, self._dirty_user_data, user_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        state = self._dump(new_state) if new_state is not None else None
+        self._mark_dirty(self._saved_conversations, self._dirty_conversations, (name, self._dump(list(key))), state)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _mark_dirty(self, saved, dirty, key, value):
+        if key not in dirty and saved.get(key) == value:
+            return
+        dirty[key] = value
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # Application вызывает update_* для всех записей сразу; даём им отработать и пишем одной пачкой
+        await asyncio.sleep(0)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Failed to save conversation state: {e}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            user_data, self._dirty_user_data = self._dirty_user_data, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            if not user_data and not conversations:
+                return
+            try:
+                await adb.save_persistence(user_data, conversations)
+            except Exception:
+                # Более новые изменения, пришедшие во время записи, не перезаписываем
+                self._dirty_user_data = {**user_data, **self._dirty_user_data}
+                self._dirty_conversations = {**conversations, **self._dirty_conversations}
+                raise
+            for saved, written in ((self._saved_user_data, user_data), (self._saved_conversations, conversations)):
+                for key, value in written.items():
+                    if value is None:
+                        saved.pop(key, None)
+                    else:
+                        saved[key] = value
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей обрабатываются параллельно, одного пользователя - строго по очереди,
+    # иначе ConversationHandler увидит сообщение раньше, чем сменится состояние диалога
+    def __init__(self, max_concurrent_updates):
+        # Семафор базового класса берётся до do_process_update, и очередь одного пользователя заняла бы
+        # все слоты. Поэтому его лимит не ограничивает, а свой семафор берётся после блокировки пользователя
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+def application_builder():
+    builder = Application.builder().token(TOKEN)
+    if TELEGRAM_API_URL:
+        api_url = TELEGRAM_API_URL.rstrip('/')
+        builder = builder.base_url(f'{api_url}/bot').base_file_url(f'{api_url}/file/bot')
+    return builder
+
+def build_application(updater=True) -> Application:
+    builder = (
+        application_builder()
+        .post_init(on_startup)
+        .post_stop(on_shutdown)
+        .persistence(SQLitePersistence())
+    )
+    if not updater:
+        builder = builder.updater(None)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', start), CommandHandler('admin', admin)],
         states={
             LANGUAGE: [
-                CallbackQueryHandler(language, pattern='^lang_(ru|en)$')
+                CallbackQueryHandler(language, pattern=f"^lang_({'|'.join(CATALOG)})$")
             ],
             TRADE: [
                 CallbackQueryHandler(start_trade, pattern='^start_trade$'),
@@ -650,34 +2856,200 @@ def main() -> None:
             ],
             ADMIN_MAIN: [
                 CallbackQueryHandler(admin_stats, pattern='^admin_stats$|^admin_stats_refresh$'),
-                CallbackQueryHandler(admin_requests, pattern='^admin_requests$'),
+                CallbackQueryHandler(admin_requests, pattern='^admin_requests(_[no]_[0-9]{14}_[0-9]+)?$'),
                 CallbackQueryHandler(admin_broadcast, pattern='^admin_broadcast$'),
                 CallbackQueryHandler(admin_check_blocks, pattern='^admin_check_blocks$'),
+                CallbackQueryHandler(bulk_select_page, pattern='^bulk_page$'),
+                CallbackQueryHandler(bulk_filter, pattern='^bulk_filter$'),
+                CallbackQueryHandler(bulk_apply, pattern='^bulk_(approved|rejected)$'),
+                CallbackQueryHandler(admin_back, pattern='^admin_back$')
+            ],
+            ADMIN_BULK_FILTER: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, bulk_filter_message),
                 CallbackQueryHandler(admin_back, pattern='^admin_back$')
             ],
             ADMIN_BROADCAST: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_confirm),
+                MessageHandler(~filters.COMMAND, admin_broadcast_message),
+                CallbackQueryHandler(admin_back, pattern='^admin_back$'),
+                CallbackQueryHandler(admin_cancel_broadcast, pattern='^admin_cancel_broadcast$')
+            ],
+            ADMIN_BROADCAST_SEGMENT: [
+                CallbackQueryHandler(admin_broadcast_segment, pattern='^segment_'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_signup_range),
                 CallbackQueryHandler(admin_back, pattern='^admin_back$'),
                 CallbackQueryHandler(admin_cancel_broadcast, pattern='^admin_cancel_broadcast$')
             ],
             ADMIN_BROADCAST_CONFIRM: [
                 CallbackQueryHandler(admin_broadcast_execute, pattern='^broadcast_confirm_yes$'),
-                CallbackQueryHandler(admin_back, pattern='^broadcast_confirm_no$|^admin_back$')
+                CallbackQueryHandler(admin_cancel_broadcast, pattern='^broadcast_confirm_no$'),
+                CallbackQueryHandler(admin_back, pattern='^admin_back$')
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
+        # /admin работает из любого состояния: иначе кнопки админ-меню не совпадут с текущим состоянием диалога
+        fallbacks=[CommandHandler('cancel', cancel), CommandHandler('admin', admin)],
+        name='main_conversation',
+        persistent=True,
         per_message=False  # Устанавливаем только здесь для всего ConversationHandler
     )
 
+    application.add_handler(TypeHandler(Update, track_activity), group=-2)
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
     application.add_handler(conv_handler)
-    application.add_handler(CommandHandler('admin', admin))
     application.add_handler(CallbackQueryHandler(handle_request_decision, pattern='^(accept|reject)_[0-9]+$'))
     application.add_error_handler(error_handler)
-    
-    application.run_polling()
+    return application
+
+class WorkerGroup:
+    # Процессы-воркеры шардированного режима. Упавший воркер перезапускается: иначе ингресс
+    # по-прежнему отвечает 200, а обновления его пользователей копятся в очереди без обработки
+    def __init__(self, count, target=None):
+        self._context = multiprocessing.get_context('spawn')
+        self._target = target or run_worker
+        self.queues = [None] * count
+        self.processes = [None] * count
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        # Очередь каждый раз новая: процесс, убитый во время get(), оставляет её блокировку захваченной
+        self.queues[index] = self._context.Queue()
+        process = self._context.Process(
+            target=self._target, args=(index, self.queues[index]), name=f'bot-worker-{index}'
+        )
+        process.start()
+        self.processes[index] = process
+
+    def check(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            logger.error(f"Worker {index} exited with code {process.exitcode}, restarting; its queued updates are lost")
+            metrics.inc('bot_worker_restarts_total')
+            stale = self.queues[index]
+            stale.cancel_join_thread()
+            stale.close()
+            self._spawn(index)
+
+    def dispatch(self, user_id, data):
+        index = user_id % len(self.queues)
+        if not self.processes[index].is_alive():
+            self.check()
+        self.queues[index].put(data)
+
+    def stop(self):
+        for index, updates in enumerate(self.queues):
+            if self.processes[index].is_alive():
+                updates.put(None)
+        for process in self.processes:
+            process.join()
+
+async def watch_workers(workers):
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        try:
+            workers.check()
+        except Exception as e:
+            logger.error(f"Worker check failed: {e}")
+
+def build_ingress_application(workers) -> Application:
+    # Ингресс только принимает обновления и раздаёт их воркерам;
+    # все обновления одного пользователя попадают к одному воркеру, вместе с его диалогом
+    async def start_watching(application: Application) -> None:
+        start_background_task(watch_workers(workers))
+
+    application = (
+        application_builder()
+        .post_init(start_watching)
+        .post_stop(stop_background_tasks)
+        .build()
+    )
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        workers.dispatch(user.id if user else 0, update.to_dict())
+
+    application.add_handler(TypeHandler(Update, route))
+    return application
+
+async def serve_worker(updates):
+    application = build_application(updater=False)
+    loop = asyncio.get_running_loop()
+    async with application:
+        await on_startup(application)
+        await application.start()
+        while (data := await loop.run_in_executor(None, updates.get)) is not None:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+        await on_shutdown(application)
+
+def run_worker(index, updates):
+    global METRICS_PORT
+    # Воркер останавливает ингресс, присылая None, а не Ctrl+C всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if METRICS_PORT:
+        METRICS_PORT += index
+    try:
+        asyncio.run(serve_worker(updates))
+    finally:
+        adb.close()
+        db.close()
+
+def run_sharded() -> None:
+    workers = WorkerGroup(WORKER_PROCESSES)
+    workers.start()
+    try:
+        run_updates(build_ingress_application(workers))
+    finally:
+        workers.stop()
+
+def run_updates(application: Application) -> None:
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        )
+    else:
+        application.run_polling()
+
+def export_table(table, fmt, output):
+    rows = db.iter_export(table)
+    columns = next(rows)
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            output.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export', help='выгрузить таблицу в JSONL или CSV')
+    export.add_argument('table', choices=sorted(EXPORT_QUERIES))
+    export.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+    export.add_argument('--output', help='файл; по умолчанию stdout')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8', newline='') as output:
+                export_table(args.table, args.format, output)
+        else:
+            export_table(args.table, args.format, sys.stdout)
+    elif WORKER_PROCESSES > 1:
+        run_sharded()
+    else:
+        run_updates(build_application())
     
 if __name__ == '__main__':
     try:
         main()
     finally:
+        adb.close()
         db.close()
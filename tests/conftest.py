@@ -0,0 +1,35 @@
+import os
+import sys
+import sqlite3
+import tempfile
+
+import pytest
+
+# bot.py открывает базу при импорте, поэтому путь к ней задаём заранее
+os.environ['DB_FILE'] = os.path.join(tempfile.mkdtemp(prefix='bot-tests-'), 'bot.db')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+@pytest.fixture
+def make_database(monkeypatch, tmp_path):
+    # Отдельная база в обход синглтона Database; prepare(conn) заполняет файл до миграций
+    opened = []
+
+    def make(prepare=None):
+        path = str(tmp_path / f'bot{len(opened)}.db')
+        if prepare:
+            conn = sqlite3.connect(path)
+            prepare(conn)
+            conn.commit()
+            conn.close()
+        monkeypatch.setattr(bot, 'DB_FILE', path)
+        database = object.__new__(bot.Database)
+        database._initialize_db()
+        opened.append(database)
+        return database
+
+    yield make
+    for database in opened:
+        database.close()
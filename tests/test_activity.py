@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import bot
+
+def stamp(days_ago, hour):
+    day = datetime.now(timezone.utc).date() - timedelta(days=days_ago)
+    return f'{day} {hour:02d}:00:00', str(day)
+
+def dau(database, day):
+    row = database._reader().execute('SELECT dau FROM daily_stats WHERE day = ?', (day,)).fetchone()
+    return row[0] if row else 0
+
+def mau(database):
+    return database._reader().execute("SELECT value FROM stats_counters WHERE name = 'mau'").fetchone()[0]
+
+def test_dau_and_mau(make_database):
+    database = make_database()
+    (early, first_day), (late, _) = stamp(2, 10), stamp(2, 20)
+    next_morning, next_day = stamp(1, 9)
+
+    database.record_activity({1: early, 2: early})
+    assert dau(database, first_day) == 2
+    # Повторная активность в тот же день не увеличивает DAU
+    database.record_activity({1: late, 3: late})
+    assert dau(database, first_day) == 3
+    assert mau(database) == 3
+
+    database.record_activity({1: next_morning})
+    assert (dau(database, first_day), dau(database, next_day)) == (3, 1)
+    # Запоздавшая отметка за прошлый день не откатывает last_seen и не считается заново
+    database.record_activity({1: early})
+    assert (dau(database, first_day), dau(database, next_day)) == (3, 1)
+    last_seen = database._reader().execute('SELECT last_seen FROM user_activity WHERE user_id = 1').fetchone()[0]
+    assert last_seen == next_morning
+
+    # Старше MAU_DAYS дней - вне окна MAU
+    database.record_activity({4: stamp(bot.MAU_DAYS + 5, 12)[0]})
+    assert mau(database) == 3
+
+def test_tracker_flush(make_database, monkeypatch):
+    database = make_database()
+    adb = bot.AsyncDatabase(database)
+    monkeypatch.setattr(bot, 'adb', adb)
+    tracker = bot.ActivityTracker()
+
+    async def run():
+        for user_id in (1, 2, 1):
+            tracker.touch(user_id)
+        assert len(tracker) == 2
+        await tracker.flush()
+        tracker.touch(2)
+        tracker.touch(3)
+        await tracker.flush()
+        assert len(tracker) == 0
+
+    asyncio.run(run())
+    stats = database.get_stats()
+    assert stats['today']['dau'] == 3
+    assert stats['mau'] == 3
+    adb.close()
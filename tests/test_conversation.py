@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import bot
+from bench import Recorder, callback, start_fake_api, text_message
+
+@pytest.fixture
+def application(monkeypatch):
+    process, port = start_fake_api(0)
+    monkeypatch.setattr(bot, 'TELEGRAM_API_URL', f'http://127.0.0.1:{port}')
+    yield bot.build_application()
+    process.terminate()
+
+def conversation_state(application, user_id):
+    handler = next(h for h in application.handlers[0] if isinstance(h, bot.ConversationHandler))
+    return handler._conversations.get((user_id, user_id))
+
+def test_admin_command_keeps_user_in_trade(application):
+    user_id = 3_000_001
+
+    async def run():
+        recorder = Recorder()
+        async with application:
+            await recorder.feed(application, 'start', text_message(user_id, '/start'))
+            await recorder.feed(application, 'language', callback(user_id, 'lang_ru'))
+            await recorder.feed(application, 'start_trade', callback(user_id, 'start_trade'))
+            assert conversation_state(application, user_id) == bot.TRADE
+            await recorder.feed(application, 'admin', text_message(user_id, '/admin'))
+            state = conversation_state(application, user_id)
+            await recorder.feed(application, 'submit', text_message(user_id, f'https://example.com/{user_id}\nS1'))
+            await bot.on_shutdown(application)
+        return state
+
+    assert asyncio.run(run()) == bot.TRADE
+    assert bot.db.find_duplicate_request(f'https://example.com/{user_id}') is not None
+
+def count_drafts():
+    reader = bot.db._reader()
+    jobs = reader.execute("SELECT COUNT(*) FROM broadcast_jobs WHERE status = 'draft'").fetchone()[0]
+    deliveries = reader.execute('''SELECT COUNT(*) FROM broadcast_deliveries WHERE job_id IN 
+    (SELECT job_id FROM broadcast_jobs WHERE status = 'draft')''').fetchone()[0]
+    return jobs, deliveries
+
+@pytest.mark.parametrize('steps', [
+    ['segment_all', 'admin_back'],
+    ['segment_all', 'broadcast_confirm_no'],
+])
+def test_leaving_broadcast_discards_draft(application, steps):
+    admin_id = bot.ADMIN_IDS[0]
+    for user_id in range(3_100_000, 3_100_005):
+        bot.db.add_user(user_id, f'user{user_id}', '', '', 'ru')
+
+    async def run():
+        recorder = Recorder()
+        async with application:
+            await recorder.feed(application, 'admin', text_message(admin_id, '/admin'))
+            await recorder.feed(application, 'broadcast', callback(admin_id, 'admin_broadcast'))
+            await recorder.feed(application, 'message', text_message(admin_id, 'Hello'))
+            drafts = []
+            for step in steps:
+                await recorder.feed(application, step, callback(admin_id, step))
+                drafts.append(count_drafts())
+            user_data = dict(application.user_data[admin_id])
+            await bot.on_shutdown(application)
+        return drafts, user_data
+
+    drafts, user_data = asyncio.run(run())
+    assert drafts[0][0] == 1 and drafts[0][1] >= 5
+    assert drafts[-1] == (0, 0)
+    assert 'broadcast_job_id' not in user_data
+
+def test_back_from_signup_range_discards_draft(application):
+    admin_id = bot.ADMIN_IDS[0]
+
+    async def run():
+        recorder = Recorder()
+        async with application:
+            await recorder.feed(application, 'admin', text_message(admin_id, '/admin'))
+            await recorder.feed(application, 'broadcast', callback(admin_id, 'admin_broadcast'))
+            await recorder.feed(application, 'message', text_message(admin_id, 'Hello'))
+            await recorder.feed(application, 'segment', callback(admin_id, 'segment_signup'))
+            await recorder.feed(application, 'range', text_message(admin_id, '2000-1-1 2100-1-1'))
+            created = count_drafts()
+            await recorder.feed(application, 'back', callback(admin_id, 'admin_back'))
+            await bot.on_shutdown(application)
+        return created, count_drafts()
+
+    created, left = asyncio.run(run())
+    assert created[0] == 1
+    assert left == (0, 0)
@@ -0,0 +1,69 @@
+import asyncio
+
+import bot
+
+def test_concurrent_writes_share_commits(make_database):
+    database = make_database()
+    adb = bot.AsyncDatabase(database, max_workers=1)
+
+    async def write_all():
+        commits = bot.metrics.counter_value('bot_db_commits_total')
+        await asyncio.gather(*(adb.add_user(user_id, f'user{user_id}', '', '', 'ru') for user_id in range(1, 501)))
+        return bot.metrics.counter_value('bot_db_commits_total') - commits
+
+    # Пачка не ограничена числом потоков пула
+    assert asyncio.run(write_all()) <= 500 // 50
+    assert database.get_stats()['active_users'] == 500
+    adb.close()
+
+def test_cancelled_write(make_database):
+    database = make_database()
+    adb = bot.AsyncDatabase(database)
+
+    async def cancel_then_write():
+        task = asyncio.create_task(adb.add_user(1, 'user1', '', '', 'ru'))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # Писатель переживает отменённую операцию
+        await adb.add_user(2, 'user2', '', '', 'ru')
+
+    asyncio.run(cancel_then_write())
+    assert database.get_user(2) is not None
+    adb.close()
+
+def test_cache_invalidated_after_commit(make_database):
+    database = make_database()
+    database.add_user(1, 'user1', '', '', 'ru')
+    assert database.get_user(1)['lang'] == 'ru'
+    database.update_user_lang(1, 'en')
+    assert database.get_user(1)['lang'] == 'en'
+
+def test_pending_requests_pagination(make_database):
+    database = make_database()
+    database._write(lambda cursor: cursor.executemany(
+        '''INSERT INTO requests (request_id, user_id, link, status, created_at) 
+        VALUES (?, ?, ?, 'pending', datetime('2024-01-01', ?))''',
+        # Пары заявок с одинаковым временем проверяют второй ключ сортировки
+        [(request_id, request_id, f'link{request_id}', f'+{request_id // 2} minutes') for request_id in range(1, 26)]
+    ))
+    database._write(lambda cursor: cursor.executemany(
+        'INSERT INTO users (user_id, username) VALUES (?, ?)', [(user_id, f'user{user_id}') for user_id in range(1, 26)]
+    ))
+
+    pages = []
+    rows, has_newer, has_older = database.get_pending_requests(per_page=10)
+    pages.append(([row['request_id'] for row in rows], has_newer, has_older))
+    while has_older:
+        position = (rows[-1]['created_at'], rows[-1]['request_id'])
+        rows, has_newer, has_older = database.get_pending_requests('older', position, per_page=10)
+        pages.append(([row['request_id'] for row in rows], has_newer, has_older))
+    assert pages == [
+        (list(range(25, 15, -1)), False, True),
+        (list(range(15, 5, -1)), True, True),
+        (list(range(5, 0, -1)), True, False),
+    ]
+
+    position = (rows[0]['created_at'], rows[0]['request_id'])
+    rows, has_newer, has_older = database.get_pending_requests('newer', position, per_page=10)
+    assert ([row['request_id'] for row in rows], has_newer, has_older) == (list(range(15, 5, -1)), True, True)
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop
+
+import bot
+from bench import callback, text_message
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, 'monotonic', clock)
+    return clock
+
+def test_parse_flood_limits():
+    assert bot.parse_flood_limits(' message=10/60, callback = 30/1.5,,') == {
+        'message': (10.0, 60.0),
+        'callback': (30.0, 1.5),
+    }
+    assert bot.parse_flood_limits('') == {}
+
+def test_drop_and_refill(clock):
+    flood = bot.FloodControl({'message': (3, 60)})
+    assert [flood.allow(1, 'message') for _ in range(4)] == [True, True, True, False]
+    # Бакеты у разных пользователей и категорий независимы; категория без лимита не ограничена
+    assert flood.allow(2, 'message')
+    assert all(flood.allow(1, 'command') for _ in range(10))
+
+    # Один токен восстанавливается за period / capacity секунд
+    clock.now += 19
+    assert not flood.allow(1, 'message')
+    clock.now += 1
+    assert flood.allow(1, 'message')
+    assert not flood.allow(1, 'message')
+
+    # Наполнение не превышает ёмкость бакета
+    clock.now += 3600
+    assert [flood.allow(1, 'message') for _ in range(4)] == [True, True, True, False]
+
+def test_prune(clock):
+    flood = bot.FloodControl({'message': (3, 60), 'callback': (3, 600)})
+    flood.allow(1, 'message')
+    flood.allow(2, 'callback')
+    clock.now += 30
+    flood.allow(3, 'message')
+    assert len(flood) == 3
+
+    clock.now += 40
+    flood._prune(clock.now)
+    assert set(flood._buckets) == {(2, 'callback'), (3, 'message')}
+
+    # allow() сам чистит бакеты не чаще раза в PRUNE_INTERVAL
+    clock.now += 100
+    flood.allow(4, 'message')
+    assert set(flood._buckets) == {(2, 'callback'), (4, 'message')}
+
+def test_flood_guard(monkeypatch):
+    monkeypatch.setattr(bot, 'flood_control', bot.FloodControl({'message': (2, 60), 'callback': (1, 60)}))
+    admin_id = bot.ADMIN_IDS[0]
+
+    def guard(payload):
+        update = Update.de_json(dict(payload, update_id=1), None)
+        try:
+            asyncio.run(bot.flood_guard(update, None))
+        except ApplicationHandlerStop:
+            return False
+        return True
+
+    dropped = bot.metrics.counter_value('bot_flood_dropped_total', category='message')
+    assert [guard(text_message(42, 'hi')) for _ in range(3)] == [True, True, False]
+    assert bot.metrics.counter_value('bot_flood_dropped_total', category='message') == dropped + 1
+    assert [guard(callback(42, 'x')) for _ in range(2)] == [True, False]
+    # Команды без лимита проходят всегда
+    assert guard(text_message(42, '/start'))
+
+    assert all(guard(text_message(admin_id, 'hi')) for _ in range(10))
+    assert len(bot.flood_control._buckets) == 2
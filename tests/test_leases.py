@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def lease_db(make_database, monkeypatch):
+    adb = bot.AsyncDatabase(make_database())
+    monkeypatch.setattr(bot, 'adb', adb)
+    monkeypatch.setattr(bot.Lease, 'held', set())
+    yield
+    adb.close()
+
+def test_concurrent_acquire_in_one_process(lease_db):
+    async def run():
+        first, second = bot.Lease('broadcast:1'), bot.Lease('broadcast:1')
+        # Оба захвата стартуют до того, как первый дождётся базы
+        results = await asyncio.gather(first.acquire(), second.acquire())
+        for lease, acquired in zip((first, second), results):
+            if acquired:
+                await lease.release()
+        return results
+
+    assert sorted(asyncio.run(run())) == [False, True]
+    assert bot.Lease.held == set()
+
+def test_failed_acquire_frees_name(lease_db):
+    async def run():
+        assert await bot.adb.acquire_lease('archiver', 'other-process', 60)
+        assert not await bot.Lease('archiver').acquire()
+        assert 'archiver' not in bot.Lease.held
+        await bot.adb.release_lease('archiver', 'other-process')
+        lease = bot.Lease('archiver')
+        assert await lease.acquire()
+        await lease.release()
+
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+import pytest
+
+from bot import link_hash, normalize_link
+
+@pytest.mark.parametrize('first, second', [
+    ('https://t.me/joinchat/AbC', 't.me/+AbC'),
+    ('@SomeChannel', 'https://www.t.me/somechannel/'),
+    ('http://telegram.me/Chan#comments', 'https://t.me/chan'),
+    ('https://example.com/trade?utm_source=x&b=2&a=1', 'example.com/trade?a=1&b=2'),
+])
+def test_same_link(first, second):
+    assert normalize_link(first) == normalize_link(second)
+    assert link_hash(first) == link_hash(second)
+
+@pytest.mark.parametrize('first, second', [
+    ('https://mega.nz/#F!abc!k1', 'https://mega.nz/#F!zzz!k2'),
+    ('https://mega.nz/folder/abc#key1', 'https://mega.nz/folder/abc#key2'),
+    ('https://t.me/+AbC', 'https://t.me/+abc'),
+])
+def test_different_links(first, second):
+    assert link_hash(first) != link_hash(second)
+
+@pytest.mark.parametrize('text', ['[Mega] my folder', 'https://[broken', '  [Mega] My Folder  '])
+def test_free_text(text):
+    assert normalize_link(text) == text.strip().lower()
+    assert link_hash(text) == link_hash(text.upper())
+
+def test_migration_with_free_text_links(make_database):
+    def baseline(conn):
+        conn.execute('''CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+        last_name TEXT, lang TEXT DEFAULT 'ru', blocked INTEGER DEFAULT 0, created_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
+        conn.execute('''CREATE TABLE requests (request_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+        link TEXT, summer_id TEXT, status TEXT DEFAULT 'pending', created_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
+        conn.executemany('INSERT INTO requests (user_id, link, summer_id) VALUES (1, ?, ?)', [
+            ('[Mega] my folder', 'S1'),
+            ('https://mega.nz/#F!abc!k1', 'S2'),
+            ('https://mega.nz/#F!zzz!k2', 'S3'),
+        ])
+
+    database = make_database(baseline)
+    assert database.find_duplicate_request('[mega] MY folder')['request_id'] == 1
+    assert database.find_duplicate_request('https://mega.nz/#F!zzz!k2')['request_id'] == 3
+    assert database.find_duplicate_request('https://mega.nz/#F!new!k3') is None
+    assert database.add_request(2, 'https://mega.nz/#F!new!k3', 'S4') is not None
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, Forbidden
+
+import bot
+
+def make_pipeline():
+    return bot.OutboundPipeline(bot.TokenBucket(1000), workers=1, max_retries=0)
+
+async def send_message(chat_id, error=None, delay=0):
+    await asyncio.sleep(delay)
+    if error is not None:
+        raise error
+    return chat_id
+
+def test_cancelled_call_failing_in_flight():
+    pipeline = make_pipeline()
+
+    async def run():
+        task = asyncio.create_task(pipeline.call(send_message, chat_id=1, error=BadRequest('Chat not found'), delay=0.05))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # Единственный воркер должен пережить ошибку отменённого запроса
+        result = await asyncio.wait_for(pipeline.call(send_message, chat_id=2), 1)
+        await pipeline.stop()
+        return result
+
+    assert asyncio.run(run()) == 2
+
+def test_forbidden_when_marking_blocked_fails(monkeypatch):
+    pipeline = make_pipeline()
+
+    async def broken(user_ids):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(bot.adb, 'mark_blocked_users', broken)
+
+    async def run():
+        try:
+            with pytest.raises(Forbidden):
+                await asyncio.wait_for(pipeline.call(send_message, chat_id=1, error=Forbidden('blocked')), 1)
+            return await asyncio.wait_for(pipeline.call(send_message, chat_id=2), 1)
+        finally:
+            await pipeline.stop()
+
+    assert asyncio.run(run()) == 2
@@ -0,0 +1,43 @@
+import pytest
+
+import bot
+
+# Архивная часть старого запроса сегмента "заявители": без ANALYZE обход шёл от users
+# и на каждого пользователя перебирал диапазон created_at в архиве
+NESTED_RANGE_SEGMENT = ('''SELECT ?, a.user_id FROM requests_archive a
+JOIN users u ON a.user_id = u.user_id
+WHERE a.created_at >= datetime('now', ?) AND u.blocked = 0''', (1, '-7 days'))
+
+def seed(cursor):
+    cursor.executemany('INSERT INTO users (user_id, username, lang, blocked) VALUES (?, ?, ?, ?)', [
+        (user_id, f'user{user_id}', 'ru', int(user_id % 7 == 0)) for user_id in range(1, 2001)
+    ])
+    cursor.executemany('''INSERT INTO requests (user_id, link, summer_id, status, link_hash, created_at)
+    VALUES (?, ?, ?, ?, ?, datetime('now', ?))''', [
+        (request_id % 2000 + 1, f'link{request_id}', f'S{request_id}',
+         ('pending', 'approved', 'rejected')[request_id % 3], request_id, f'-{request_id % 90} days')
+        for request_id in range(1, 5001)
+    ])
+
+@pytest.fixture
+def database(make_database):
+    database = make_database()
+    database._write(seed)
+    return database
+
+def test_hot_queries_use_indexes(database):
+    assert database.check_query_plans() == {}
+
+@pytest.mark.parametrize('name', sorted(bot.HOT_QUERIES))
+def test_hot_query_plan(database, name):
+    sql, params = bot.HOT_QUERIES[name]
+    assert database._plan_problems(database._query_plan(sql, params)) == []
+
+@pytest.mark.parametrize('sql, params', [
+    NESTED_RANGE_SEGMENT,
+    ('SELECT * FROM requests WHERE summer_id = ?', ('S1',)),
+    ('SELECT user_id FROM users ORDER BY username', ()),
+])
+def test_bad_plans_are_reported(database, monkeypatch, sql, params):
+    monkeypatch.setattr(bot, 'HOT_QUERIES', {'bad': (sql, params)})
+    assert list(database.check_query_plans()) == ['bad']
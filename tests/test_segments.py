@@ -0,0 +1,89 @@
+import asyncio
+
+import bot
+
+USERS = 20_000
+
+def seed(cursor):
+    cursor.executemany('INSERT INTO users (user_id, username, lang, blocked) VALUES (?, ?, ?, ?)', [
+        (user_id, f'user{user_id}', 'en' if user_id % 3 else 'ru', int(user_id % 10 == 0))
+        for user_id in range(1, USERS + 1)
+    ])
+    # Свежие заявки в рабочей таблице и в архиве, плюс старые, не попадающие в сегмент
+    cursor.executemany('''INSERT INTO requests (user_id, link, status, created_at)
+    VALUES (?, ?, 'pending', datetime('now', ?))''', [
+        (user_id, f'r{user_id}', '-2 days' if user_id <= 300 else '-60 days') for user_id in range(1, 601)
+    ])
+    cursor.executemany('''INSERT INTO requests_archive (request_id, user_id, link, status, created_at, processed_at)
+    VALUES (?, ?, ?, 'approved', datetime('now', ?), datetime('now'))''', [
+        (request_id, 200 + request_id, f'a{request_id}', '-10 days' if request_id <= 500 else '-90 days')
+        for request_id in range(1, 1001)
+    ])
+
+def recipients(database, job_id):
+    rows = database._reader().execute('SELECT user_id FROM broadcast_deliveries WHERE job_id = ?', (job_id,))
+    return {row[0] for row in rows}
+
+def test_requesters_segment(make_database):
+    database = make_database()
+    database._write(seed)
+
+    job_id = database.create_broadcast_job(1, 1, 1, 'text', segment={'kind': 'requesters', 'days': 30}, draft=True)
+    expected = {user_id for user_id in range(1, 701) if user_id % 10}
+    assert recipients(database, job_id) == expected
+    assert database.get_broadcast_job(job_id)['total_users'] == len(expected)
+
+    job_id = database.create_broadcast_job(1, 1, 1, 'text', segment={'kind': 'requesters', 'days': 7}, draft=True)
+    assert recipients(database, job_id) == {user_id for user_id in range(1, 301) if user_id % 10}
+
+def test_requesters_segment_plan(make_database):
+    # Обход начинается со свежих заявок, а не с активных пользователей
+    database = make_database()
+    database._write(seed)
+    sql, params = bot.HOT_QUERIES['segment_requesters']
+    plan = database.explain_query_plan(sql, params)
+    searches = [step for step in plan if step.startswith(('SEARCH', 'SCAN'))]
+    assert searches == [
+        'SEARCH requests USING COVERING INDEX idx_requests_created_user (created_at>?)',
+        'SEARCH u USING INTEGER PRIMARY KEY (rowid=?)',
+        'SEARCH requests_archive USING COVERING INDEX idx_requests_archive_created_user (created_at>?)',
+        'SEARCH u USING INTEGER PRIMARY KEY (rowid=?)',
+    ]
+
+def test_other_segments(make_database):
+    database = make_database()
+    database._write(seed)
+    job_id = database.create_broadcast_job(1, 1, 1, 'text', draft=True)
+    assert len(recipients(database, job_id)) == USERS - USERS // 10
+    job_id = database.create_broadcast_job(1, 1, 1, 'text', segment={'kind': 'lang', 'lang': 'ru'}, draft=True)
+    assert recipients(database, job_id) == {user_id for user_id in range(3, USERS + 1, 3) if user_id % 10}
+
+def test_signup_segment_dates_without_padding(make_database):
+    database = make_database()
+    database._write(lambda cursor: cursor.executemany(
+        'INSERT INTO users (user_id, username, created_at) VALUES (?, ?, ?)',
+        [(1, 'user1', '2024-01-10 12:00:00'), (2, 'user2', '2024-01-20 12:00:00'), (3, 'user3', '2024-02-01 00:00:00')]
+    ))
+    for since, until in [('2024-01-05', '2024-01-31'), ('2024-1-5', '2024-1-31')]:
+        segment = {'kind': 'signup', 'since': since, 'until': until}
+        job_id = database.create_broadcast_job(1, 1, 1, 'text', segment=segment, draft=True)
+        assert recipients(database, job_id) == {1, 2}
+
+def test_signup_range_is_stored_canonical(monkeypatch):
+    segments = []
+
+    async def confirm(update, context, segment, send):
+        segments.append(segment)
+
+    class Message:
+        text = '2024-1-5 2024-1-31'
+
+        async def reply_text(self, *args, **kwargs):
+            pass
+
+    class Update:
+        message = Message()
+
+    monkeypatch.setattr(bot, 'admin_broadcast_confirm', confirm)
+    asyncio.run(bot.admin_broadcast_signup_range(Update(), None))
+    assert segments == [{'kind': 'signup', 'since': '2024-01-05', 'until': '2024-01-31'}]
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import signal
+import time
+
+import pytest
+
+import bot
+from bench import Recorder, callback, start_fake_api, text_message
+
+@pytest.fixture
+def workers(monkeypatch):
+    # Воркеры запускаются через spawn и читают настройки из окружения
+    process, port = start_fake_api(0)
+    monkeypatch.setenv('TELEGRAM_API_URL', f'http://127.0.0.1:{port}')
+    monkeypatch.setattr(bot, 'TELEGRAM_API_URL', f'http://127.0.0.1:{port}')
+    workers = bot.WorkerGroup(2)
+    workers.start()
+    yield workers
+    workers.stop()
+    process.terminate()
+
+def sign_up(workers, user_ids):
+    # Пользователь появляется в базе после выбора языка
+    async def run():
+        application = bot.build_ingress_application(workers)
+        recorder = Recorder()
+        async with application:
+            for user_id in user_ids:
+                await recorder.feed(application, 'start', text_message(user_id, '/start'))
+                await recorder.feed(application, 'language', callback(user_id, 'lang_ru'))
+
+    asyncio.run(run())
+
+def wait_for_users(user_ids, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        bot.db.user_cache.invalidate(user_ids)
+        if all(bot.db.get_user(user_id) for user_id in user_ids):
+            return True
+        time.sleep(0.2)
+    return False
+
+def test_dead_worker_is_restarted(workers):
+    sign_up(workers, [4_000_000, 4_000_001])
+    assert wait_for_users([4_000_000, 4_000_001])
+
+    # Воркер убит, пока ждёт обновлений в get(): его очередь остаётся заблокированной
+    os.kill(workers.processes[1].pid, signal.SIGKILL)
+    workers.processes[1].join()
+    before = bot.metrics.counter_value('bot_worker_restarts_total')
+
+    sign_up(workers, [4_000_002, 4_000_003])
+    assert bot.metrics.counter_value('bot_worker_restarts_total') == before + 1
+    assert all(process.is_alive() for process in workers.processes)
+    assert wait_for_users([4_000_002, 4_000_003])
+
+def test_watch_restarts_idle_worker(workers, monkeypatch):
+    monkeypatch.setattr(bot, 'WORKER_CHECK_INTERVAL', 0.05)
+    workers.processes[0].kill()
+    workers.processes[0].join()
+
+    async def run():
+        task = asyncio.create_task(bot.watch_workers(workers))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert all(process.is_alive() for process in workers.processes)
+    sign_up(workers, [4_000_004])
+    assert wait_for_users([4_000_004])
@@ -0,0 +1,82 @@
+import bot
+
+def baseline(conn):
+    # База до появления счётчиков: их заполняет миграция
+    conn.execute('''CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+    last_name TEXT, lang TEXT DEFAULT 'ru', blocked INTEGER DEFAULT 0, created_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE requests (request_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+    link TEXT, summer_id TEXT, status TEXT DEFAULT 'pending', created_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    conn.executemany("INSERT INTO users (user_id, username, blocked, created_at) VALUES (?, ?, ?, datetime('now', ?))", [
+        (1, 'user1', 0, '-3 days'),
+        (2, 'user2', 0, '-1 day'),
+        (3, 'user3', 0, '-1 day'),
+        (4, 'user4', 1, '-1 day'),
+    ])
+    conn.executemany('''INSERT INTO requests (request_id, user_id, link, status, created_at) 
+    VALUES (?, ?, ?, ?, datetime('now', '-1 day'))''', [
+        (1, 1, 'https://example.com/1', 'pending'),
+        (2, 2, 'https://example.com/2', 'approved'),
+        (3, 2, 'https://example.com/3', 'rejected'),
+    ])
+
+def scalar(database, sql, *params):
+    return database._reader().execute(sql, params).fetchone()[0]
+
+def assert_consistent(database):
+    database._stats_snapshot = None
+    stats = database.get_stats()
+    assert stats['active_users'] == scalar(database, 'SELECT COUNT(*) FROM users WHERE blocked = 0')
+    for status in ('pending', 'approved', 'rejected'):
+        assert stats[f'requests_{status}'] == scalar(database, 'SELECT COUNT(*) FROM requests WHERE status = ?', status)
+
+    for key, day in (('today', "date('now')"), ('yesterday', "date('now', '-1 day')")):
+        assert stats[key]['signups'] == scalar(
+            database, f'SELECT COUNT(*) FROM users WHERE blocked = 0 AND date(created_at) = {day}'
+        )
+        assert stats[key]['requests_created'] == scalar(
+            database, f'SELECT COUNT(*) FROM requests WHERE date(created_at) = {day}'
+        )
+    for status in ('approved', 'rejected'):
+        assert stats['today'][f'requests_{status}'] == scalar(
+            database, "SELECT COUNT(*) FROM requests WHERE status = ? AND date(processed_at) = date('now')", status
+        )
+    # Блокировки до миграции в дневную статистику не попадают
+    assert stats['today']['blocks'] == scalar(database, 'SELECT COUNT(*) FROM users WHERE blocked = 1') - 1
+    return stats
+
+def test_rollups_match_tables(make_database):
+    database = make_database(baseline)
+    assert_consistent(database)
+
+    for user_id in (10, 11, 12, 13, 1):
+        database.add_user(user_id, f'user{user_id}', '', '', 'ru')
+    assert_consistent(database)
+
+    request_ids = [database.add_request(user_id, f'https://example.com/new/{user_id}', 'S') for user_id in (10, 11, 12, 13)]
+    assert database.add_request(10, 'example.com/new/10/', 'S') is None
+    assert_consistent(database)
+
+    first, second, third, fourth = request_ids
+    database.update_request_status(first, 'approved')
+    database.update_request_status(second, 'rejected')
+    assert_consistent(database)
+    # Пересмотр решений, в том числе принятого до миграции
+    database.update_request_status(first, 'rejected')
+    database.update_request_status(second, 'approved')
+    database.update_request_status(second, 'approved')
+    database.update_request_status(2, 'rejected')
+    database.update_request_status(3, 'pending')
+    assert_consistent(database)
+
+    assert [row['request_id'] for row in database.bulk_update_request_status({'ids': [third, fourth, 1]}, 'approved')] == [1, third, fourth]
+    database.update_request_status(third, 'pending')
+    assert_consistent(database)
+
+    # Пользователь 1 зарегистрировался три дня назад, 3 - вчера, 10 - сегодня
+    assert database.mark_blocked_users([1, 4]) == 1
+    job_id = database.create_broadcast_job(1, 1, 1, 'text')
+    database.checkpoint_broadcast(job_id, [(3, 'blocked'), (2, 'sent')])
+    database.record_block_checks([(10, 'blocked'), (11, 'ok'), (3, 'blocked')])
+    stats = assert_consistent(database)
+    assert stats['today']['blocks'] == 3
+    assert stats['yesterday']['signups'] == 1
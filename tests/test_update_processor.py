@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+from telegram import Update
+
+import bot
+from bench import text_message
+
+def make_update(update_id, user_id):
+    return Update.de_json(dict(text_message(user_id, 'text'), update_id=update_id), None)
+
+def test_burst_does_not_hold_other_users():
+    processor = bot.PerUserUpdateProcessor(4)
+    order = []
+
+    async def handle(user_id, delay):
+        order.append(user_id)
+        await asyncio.sleep(delay)
+
+    async def run():
+        burst = [
+            asyncio.create_task(processor.process_update(make_update(i, 1), handle(1, 0.1)))
+            for i in range(10)
+        ]
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await processor.process_update(make_update(100, 2), handle(2, 0))
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*burst)
+        return elapsed
+
+    # Обновления одного пользователя идут по очереди и не занимают слоты, пока ждут своей блокировки
+    assert asyncio.run(run()) < 0.05
+    assert order.count(1) == 10
+
+def test_concurrency_limit():
+    processor = bot.PerUserUpdateProcessor(2)
+    running = []
+    peak = []
+
+    async def handle():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def run():
+        await asyncio.gather(*(processor.process_update(make_update(i, i), handle()) for i in range(1, 9)))
+
+    asyncio.run(run())
+    assert max(peak) == 2